@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of arxiv_reader.py on synthetic arXiv digests.
+
+'arxiv_bench.py digest N' writes a digest email with N entries (in the format
+of the daily arXiv listings which ArXivParser parses) to the standard output,
+for example to try the reader on a large digest:
+
+    arxiv_bench.py digest 10000 | arxiv_reader.py
+
+'arxiv_bench.py run' times parsing, the title layout (wrap_line()), the
+highlight classification, the database status lookups and the relevance
+scores on digests of 100, 1000 and 10000 entries and writes the results as
+JSON.  With
+'--baseline FILE' the results are compared with a stored run and the exit
+status is 1 if a benchmark got slower by more than the tolerance:
+
+    arxiv_bench.py run -o baseline.json
+    ... change arxiv_reader.py ...
+    arxiv_bench.py run --baseline baseline.json
+"""
+
+import sys
+import os
+import re
+import random
+import datetime
+import textwrap
+import tempfile
+import shutil
+import platform
+import argparse
+import json
+import timeit
+
+from arxiv_reader import (ArXivParser, ArXivDB, TitleLayout, email_Parser,
+                          highlight_class, RelevanceModel)
+
+SIZES = (100, 1000, 10000)
+    # number of entries of the benchmarked digests
+SEPARATOR = "-"*78
+
+WORDS = """
+algebraic geometry stacks sheaves schemes moduli spaces derived categories
+cohomology of the motivic homotopy theory for quasi-coherent modules on
+curves surfaces varieties with singularities and a conjecture about finite
+groups representations Lie algebras operads quantum field theories
+topological invariants knots manifolds we prove that show construct new
+examples classification theorem dimension over fields characteristic zero
+positive local global duality spectral sequences vanishing results
+""".split()
+NAMES = """
+Alice Author Bob Builder Carl Coder Dana Deligne Emil Euler Fatima Fermat
+Gustav Gauss Hanna Hilbert Ivan Ito Jun Jacobi Kurt Kodaira Lena Lefschetz
+Marcin Szamotulski Nils Noether Olga Oka Pierre Poincare Quentin Quillen
+""".split()
+CATEGORIES = ("math.AG", "math.AT", "math.CT", "math.GR", "math.KT",
+              "math.NT", "math.QA", "math.RT", "hep-th", "math-ph")
+
+AUTHOR_PATTERN = re.compile(r"\bSzamotulski\b")
+ABSTRACT_PATTERN = re.compile(r"stacks? are", re.IGNORECASE)
+    # the highlight patterns (as made by arxiv_reader.highlight_patterns())
+
+
+def sentence(rand, words):
+    return " ".join(rand.choice(WORDS) for _ in range(words))
+
+
+def field(name, value):
+    """
+    A field of an entry wrapped as in the arXiv emails: the continuation
+    lines are indented.
+    """
+    return textwrap.wrap("%s: %s" % (name, value), 78,
+                         subsequent_indent="  ", break_long_words=False,
+                         break_on_hyphens=False)
+
+
+def make_entry(rand, arxiv_nr, time, abstract=True, comments=True):
+    """
+    The lines of an entry of a digest.
+    """
+    lines = ["\\\\", "arXiv:%s" % arxiv_nr]
+    if rand.random() < 0.2:
+        lines.append("replaced with revised version %s   (%dkb)"
+                     % (time.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+                        rand.randint(5, 900)))
+    else:
+        lines.append("Date: %s   (%dkb)"
+                     % (time.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+                        rand.randint(5, 900)))
+    lines.append("")
+    lines.extend(field("Title", sentence(rand, rand.randint(4, 25))))
+    authors = [" ".join(rand.sample(NAMES, 2))
+               for _ in range(rand.randint(1, 6))]
+    lines.extend(field("Authors", ", ".join(authors[:-1])
+                       + (len(authors) > 1 and " and " or "") + authors[-1]))
+    lines.append("Categories: %s" % " ".join(rand.sample(CATEGORIES,
+                                                         rand.randint(1, 3))))
+    if comments:
+        lines.extend(field("Comments", "%d pages, %s"
+                           % (rand.randint(4, 120),
+                              sentence(rand, rand.randint(0, 12)))))
+    if rand.random() < 0.3:
+        lines.append("MSC-class: %dA%02d" % (rand.randint(11, 81),
+                                              rand.randint(1, 99)))
+    if abstract:
+        lines.append("\\\\")
+        lines.extend(textwrap.wrap(sentence(rand, rand.randint(60, 250)),
+                                   78, initial_indent="  ",
+                                   break_on_hyphens=False))
+    lines.append("\\\\ ( http://arxiv.org/abs/%s ,  %dkb)"
+                 % (arxiv_nr, rand.randint(5, 900)))
+    return lines
+
+
+def make_digest(entries, abstracts=1.0, comments=0.5, seed=0):
+    """
+    A digest email with the given number of entries.  abstracts and comments
+    are the fractions of the entries which include an abstract and comments.
+    The same seed gives the same email.
+    """
+    rand = random.Random(seed)
+    day = datetime.datetime(2012, 6, 14, 20)
+    lines = ["From: no-reply@arXiv.org (send mail ONLY to cs)",
+             "To: rabble@arXiv.org",
+             "Subject: math daily Subject Listing",
+             "Date: %s +0000" % day.strftime("%a, %d %b %Y %H:%M:%S"),
+             "Message-ID: <bench-%d-%d@arXiv.org>" % (entries, seed),
+             "Content-Type: text/plain; charset=utf-8",
+             "",
+             "Submissions to:",
+             "Mathematics",
+             "received from  %s to  %s"
+             % ((day-datetime.timedelta(days=1)).strftime("%a %d %b %y"),
+                day.strftime("%a %d %b %y")),
+             SEPARATOR]
+    for i in range(entries):
+        # arxiv_nr's have four digits after the dot (as in 2012)
+        arxiv_nr = "%d.%04d" % (1206+i//10000, i % 10000)
+        time = day-datetime.timedelta(seconds=rand.randint(0, 24*60*60))
+        lines.extend(make_entry(rand, arxiv_nr, time,
+                                abstract=rand.random() < abstracts,
+                                comments=rand.random() < comments))
+        lines.append(SEPARATOR)
+    lines.append("")
+    return "\n".join(lines)
+
+
+def parse_digest(message):
+    arxiv = email_Parser(ArXivParser).parsestr(message)
+    arxiv.parse()
+    return arxiv.data
+
+
+def best_time(func, repeat):
+    """
+    The shortest of repeat runs of func() in seconds.
+    """
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def run_benchmarks(sizes, repeat, width=80):
+    """
+    Returns {name: seconds} for the benchmarks (named 'parse/100',
+    'layout/100', ...).
+    """
+    results = {}
+    tmpdir = tempfile.mkdtemp(prefix="arxiv_bench")
+    try:
+        for size in sizes:
+            message = make_digest(size, seed=size).decode("utf8")
+            data = parse_digest(message)
+
+            results["parse/%d" % size] = best_time(
+                lambda: parse_digest(message), repeat)
+            results["layout/%d" % size] = best_time(
+                lambda: TitleLayout(data).update(width).rows(), repeat)
+            results["highlight/%d" % size] = best_time(
+                lambda: [highlight_class(d, AUTHOR_PATTERN, ABSTRACT_PATTERN)
+                         for d in data],
+                repeat)
+
+            # every other entry of the digest is saved
+            db = ArXivDB(os.path.join(tmpdir, "arxiv-%d.db" % size))
+            db.save(data[::2])
+            nrs = [d.arxiv_nr for d in data]
+            results["db_saved/%d" % size] = best_time(lambda: db.saved(nrs),
+                                                      repeat)
+            model = RelevanceModel()
+            model.sync(db)
+            results["rank/%d" % size] = best_time(lambda: model.scores(data),
+                                                  repeat)
+            db.close()
+            sys.stderr.write("%d entries: %s\n"
+                             % (size, ", ".join(
+                                 "%s %.4fs" % (name.split("/")[0],
+                                               results[name])
+                                 for name in sorted(results)
+                                 if name.endswith("/%d" % size))))
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the results next to the baseline.  Returns the names of the
+    benchmarks which are slower than the baseline by more than tolerance
+    (a fraction).
+    """
+    slower = []
+    sys.stdout.write("%-20s %10s %10s %8s\n"
+                     % ("benchmark", "baseline", "now", "ratio"))
+    for name in sorted(results, key=lambda name: (name.split("/")[0],
+                                                  int(name.split("/")[1]))):
+        if name not in baseline:
+            sys.stdout.write("%-20s %10s %10.4f\n"
+                             % (name, "-", results[name]))
+            continue
+        ratio = results[name]/max(baseline[name], 1e-9)
+        if ratio > 1+tolerance:
+            slower.append(name)
+        sys.stdout.write("%-20s %10.4f %10.4f %7.2fx%s\n"
+                         % (name, baseline[name], results[name], ratio,
+                            ratio > 1+tolerance and "  SLOWER" or ""))
+    return slower
+
+
+def digest_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="arxiv_bench.py digest",
+        description="Write a synthetic arXiv digest email to stdout.")
+    parser.add_argument("entries", type=int)
+    parser.add_argument("--abstracts", type=float, default=1.0,
+                        help="fraction of entries with an abstract")
+    parser.add_argument("--comments", type=float, default=0.5,
+                        help="fraction of entries with comments")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    sys.stdout.write(make_digest(args.entries, args.abstracts, args.comments,
+                                 args.seed))
+    return os.EX_OK
+
+
+def run_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="arxiv_bench.py run",
+        description="Time parsing, title layout, highlighting, database "
+                    "lookups and relevance scores on synthetic digests.")
+    parser.add_argument("-n", "--sizes", default=",".join(map(str, SIZES)),
+                        help="comma separated numbers of entries "
+                             "(default: %(default)s)")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="the best of REPEAT runs is reported")
+    parser.add_argument("-o", "--output", default="-",
+                        help="write the results (JSON) to this file")
+    parser.add_argument("-b", "--baseline",
+                        help="compare with the results stored in this file")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against the baseline "
+                             "(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = run_benchmarks(sizes, args.repeat)
+    report = {
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output == "-":
+        if not args.baseline:
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as sock:
+            json.dump(report, sock, indent=2, sort_keys=True)
+            sock.write("\n")
+    if args.baseline:
+        with open(args.baseline) as sock:
+            baseline = json.load(sock)["results"]
+        slower = compare(results, baseline, args.tolerance)
+        if slower:
+            sys.stdout.write("slower than the baseline: %s\n"
+                             % ", ".join(slower))
+            return 1
+    return os.EX_OK
+
+
+COMMANDS = {
+    'digest': digest_main,
+    'run': run_main,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        sys.stderr.write("usage: arxiv_bench.py {%s} ...\n"
+                         % ",".join(sorted(COMMANDS)))
+        sys.exit(os.EX_USAGE if hasattr(os, 'EX_USAGE') else 2)
+    sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
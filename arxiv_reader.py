@@ -19,7 +19,12 @@ email it is downloaded from the article arxiv web page.
 
 Use 'u' to open the url with BROWSER.
 Use 's' to add an article to the database "${HOME}/.arxiv.db" (sqlite3),
-use 'd' to remove an article from the database.
+use 'd' to remove an article from the database.  Use 'm' to mark/unmark an
+article, 'v' to mark all articles from the last (un)marked one to the current
+one, 'M' to mark all highlighted articles and 'c' to clear the marks.  If
+there are marked articles 's' and 'd' act on all of them.  Use '/' to search
+the database (title, authors, abstract and comments), the results are ranked
+by relevance.
 
 If you define ${ARXIV_AUTHORS} environment variable titles of matching authors
 will be highlighted. ${ARXIV_AUTHORS} is a white space separated list of names.
@@ -30,6 +35,20 @@ like r"" litterals).
 
 The script assumes utf8 encoding for both input (the email) and the terminal
 output.
+
+'arxiv_reader.py MAILBOX...' reads all arXiv emails in the given mbox files
+or Maildir folders (e.g. the digests of a whole day) in one session, from the
+oldest to the newest: a paper which is in several of them (a cross-list or a
+replacement) is listed once, with the metadata of the newest one.
+
+Without the terminal: 'arxiv_reader.py batch MAILBOX...' parses all arXiv
+emails in the given mbox files or Maildir folders in a pool of processes and
+writes their entries (with the highlight class: 1 author, 2 pattern match, 0
+none) as JSON lines.
+
+'arxiv_reader.py export [-f jsonl|bibtex|csv]' writes the papers saved in the
+database, optionally only those saved in a range of dates or with a given
+status, category or author ('arxiv_reader.py export -h' lists the options).
 """
 
 """
@@ -46,18 +65,40 @@ import sys
 import os
 import os.path
 import re
+import bisect
 import datetime
 import textwrap
 import curses
 import curses.textpad
 from _curses import error as CursesError
-from sgmllib import SGMLParser
+from HTMLParser import HTMLParser
 import sqlite3
 import subprocess
 import urllib
+import urlparse
+import httplib
+import socket
+import errno
+import hashlib
+import json
+import csv
+import math
+import time
+import threading
+import Queue
+import cPickle
+import multiprocessing
+import itertools
+import argparse
+import mailbox
+import xml.etree.cElementTree as ElementTree
 import logging
+import atexit
 from email.message import Message
 from email.parser import Parser as email_Parser
+from email.parser import HeaderParser as email_HeaderParser
+from email.utils import parsedate_tz as email_parsedate_tz
+from email.utils import mktime_tz as email_mktime_tz
 from email.iterators import body_line_iterator as email_iterator
 
 BROWSER = os.getenv('BROWSER')
@@ -66,9 +107,53 @@ if not BROWSER:
 PDFVIEWER = os.getenv('PDFVIEWER')
 if not PDFVIEWER:
     PDFVIEWER = 'okular'
-DOWNLOADDIR = os.path.expandvars(os.path.join('$HOME', 'downloads'))
+DOWNLOADDIR = os.getenv('DOWNLOADDIR')
+if not DOWNLOADDIR:
+    DOWNLOADDIR = os.path.expandvars(os.path.join('$HOME', 'downloads'))
+    if not os.path.isdir(DOWNLOADDIR):
+        DOWNLOADDIR = os.path.expandvars(os.path.join('$HOME', 'Downloads'))
 if not os.path.isdir(DOWNLOADDIR):
     DOWNLOADDIR = '/tmp'
+ARXIV_PREFETCH = int(os.getenv('ARXIV_PREFETCH') or 4)
+    # number of threads which fetch missing abstracts in the background (0
+    # turns it off)
+ARXIV_CACHE = (os.getenv('ARXIV_CACHE')
+               or os.path.expandvars(os.path.join('$HOME', '.cache',
+                                                  'arxiv_reader')))
+    # directory of the cache of arxiv web pages
+ARXIV_CACHE_TTL = int(os.getenv('ARXIV_CACHE_TTL') or 24*60*60)
+    # seconds for which a cached page is used without asking the server
+ARXIV_CACHE_SIZE = int(os.getenv('ARXIV_CACHE_SIZE') or 50*1024*1024)
+    # bytes: above it the least recently used pages are removed
+ARXIV_DIGEST_DAYS = float(os.getenv('ARXIV_DIGEST_DAYS') or 7)
+    # parsed digests which were not opened for this many days are removed
+    # from the cache
+ARXIV_DIGEST_CACHE_SIZE = int(os.getenv('ARXIV_DIGEST_CACHE_SIZE')
+                              or 20*1024*1024)
+    # bytes: above it the least recently opened digests are removed
+ARXIV_CONNECTIONS = int(os.getenv('ARXIV_CONNECTIONS') or 4)
+    # the maximal number of simultaneous connections to arxiv.org
+ARXIV_TIMEOUT = float(os.getenv('ARXIV_TIMEOUT') or 20)
+    # seconds after which a network operation fails
+ARXIV_API = os.getenv('ARXIV_API') or 'http://export.arxiv.org/api/query'
+    # the arxiv API (Atom feeds), which is asked for the missing abstracts of
+    # many papers at once
+ARXIV_API_BATCH = int(os.getenv('ARXIV_API_BATCH') or 100)
+    # the number of papers in one query of the arxiv API (0 turns it off:
+    # then every abstract is read from the web page of its paper)
+ARXIV_SEEN = (os.getenv('ARXIV_SEEN') or 'dim').lower()
+    # the titles of papers whose details were viewed before: 'dim' them,
+    # 'hide' them or 'off' (they are not recorded either)
+ARXIV_SEEN_DB = (os.getenv('ARXIV_SEEN_DB')
+                 or os.path.join(ARXIV_CACHE, 'seen.db'))
+    # the sqlite3 database of the viewed papers
+ARXIV_RANK = (os.getenv('ARXIV_RANK') or 'shade').lower()
+    # score the entries by their similarity to the saved papers (see
+    # RelevanceModel): 'shade' shows the best tenth of them in bold, 'sort'
+    # also lists them best first, 'off' does not score them
+ARXIV_MODEL = (os.getenv('ARXIV_MODEL')
+               or os.path.join(ARXIV_CACHE, 'relevance.pickle'))
+    # the file of the RelevanceModel
 
 if not hasattr(os, 'EX_OK'):
     os.EX_OK = 0
@@ -105,6 +190,114 @@ time    time from the arxiv
 date    date when the entry was added to the database.
 """
 
+LINKS_SCHEMA = """
+CREATE INDEX arxiv_time ON arxiv (time);
+CREATE INDEX arxiv_date ON arxiv (date);
+CREATE INDEX arxiv_status ON arxiv (status);
+CREATE TABLE author (
+    id          integer primary key,
+    name        text unique not null
+);
+CREATE TABLE arxiv_author (
+    arxiv_nr    text not null,
+    author_id   integer not null,
+    position    integer,
+    primary key (arxiv_nr, author_id)
+) WITHOUT ROWID;
+CREATE INDEX arxiv_author_author ON arxiv_author (author_id);
+CREATE TABLE category (
+    id          integer primary key,
+    name        text unique not null
+);
+CREATE TABLE arxiv_category (
+    arxiv_nr    text not null,
+    category_id integer not null,
+    primary key (arxiv_nr, category_id)
+) WITHOUT ROWID;
+CREATE INDEX arxiv_category_category ON arxiv_category (category_id);
+CREATE TRIGGER arxiv_links_delete AFTER DELETE ON arxiv BEGIN
+    DELETE FROM arxiv_author WHERE arxiv_nr = old.arxiv_nr;
+    DELETE FROM arxiv_category WHERE arxiv_nr = old.arxiv_nr;
+END;
+"""
+"""
+author          the names of the authors of saved papers
+arxiv_author    which papers (arxiv_nr) have which authors, and at which
+                position in the list of authors
+category        the arxiv categories of saved papers (math.AG, ...)
+arxiv_category  which papers have which categories
+The link tables are filled by ArXivDB.save() together with the arxiv table,
+the trigger removes the links of a deleted paper.  The schema version is in
+PRAGMA user_version (see ArXivDB.MIGRATIONS).
+"""
+
+AUTHORS_SEPARATOR = re.compile(r",\s*(?:and\s+)?|\s+and\s+")
+AFFILIATION_PATTERN = re.compile(r"\([^()]*\)")
+
+
+def split_authors(authors):
+    """
+    The list of names in the 'Authors: ' field of an entry (without the
+    affiliations in parentheses).
+    """
+    while AFFILIATION_PATTERN.search(authors or ""):
+        authors = AFFILIATION_PATTERN.sub("", authors)
+    return [WHITESPACE_PATTERN.sub(" ", name).strip()
+            for name in AUTHORS_SEPARATOR.split(authors or "")
+            if name.strip()]
+
+
+def sql_statements(script):
+    """
+    Split an SQL script into its statements (the triggers contain
+    semicolons).
+    """
+    statements = []
+    statement = ""
+    for part in script.split(";"):
+        statement += part+";"
+        if sqlite3.complete_statement(statement):
+            if statement.strip(" \n;"):
+                statements.append(statement.strip())
+            statement = ""
+    return statements
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE arxiv_fts USING fts5 (
+    title,
+    authors,
+    abstract,
+    comments,
+    content='arxiv',
+    content_rowid='rowid'
+);
+CREATE TRIGGER arxiv_fts_insert AFTER INSERT ON arxiv BEGIN
+    INSERT INTO arxiv_fts (rowid, title, authors, abstract, comments)
+    VALUES (new.rowid, new.title, new.authors, new.abstract, new.comments);
+END;
+CREATE TRIGGER arxiv_fts_delete AFTER DELETE ON arxiv BEGIN
+    INSERT INTO arxiv_fts (arxiv_fts, rowid, title, authors, abstract,
+                           comments)
+    VALUES ('delete', old.rowid, old.title, old.authors, old.abstract,
+            old.comments);
+END;
+CREATE TRIGGER arxiv_fts_update AFTER UPDATE ON arxiv BEGIN
+    INSERT INTO arxiv_fts (arxiv_fts, rowid, title, authors, abstract,
+                           comments)
+    VALUES ('delete', old.rowid, old.title, old.authors, old.abstract,
+            old.comments);
+    INSERT INTO arxiv_fts (rowid, title, authors, abstract, comments)
+    VALUES (new.rowid, new.title, new.authors, new.abstract, new.comments);
+END;
+INSERT INTO arxiv_fts (arxiv_fts) VALUES ('rebuild');
+"""
+"""
+arxiv_fts   full text index of the arxiv table (an external content fts5
+            table, kept in sync by the triggers).  If the rowids of the arxiv
+            table change (VACUUM) it can be rebuilt with:
+                INSERT INTO arxiv_fts (arxiv_fts) VALUES ('rebuild');
+"""
+
 # DONE: color titles with the given authors.
 # XXX: if the window has not enough lines the program should break.
 # XXX: implement help (clear window and list help)
@@ -114,269 +307,2068 @@ arxiv_db = (os.getenv("ARXIV_DB") and [os.getenv("ARXIV_DB")]
             or [os.path.expandvars(os.path.join("${HOME}", ".arxiv.db"))])[0]
 log_file = (os.getenv("ARXIV_LOG") and [os.getenv("ARXIV_LOG")]
             or ["/tmp/arxiv_reader.log"])[0]
-logging.basicConfig(
-    filename=log_file,
-    format="%(funcName)s at line %(lineno)d: %(message)s",
-    level=logging.INFO,
-    filemode="w")
+log_level = getattr(logging, (os.getenv("ARXIV_LOG_LEVEL") or "").upper(),
+                    logging.WARNING)
+    # ${ARXIV_LOG_LEVEL}: DEBUG, INFO, WARNING (the default) or ERROR
+log_handler = logging.FileHandler(log_file, delay=True)
+    # the log file is opened only when the first record is written
+log_handler.setFormatter(
+    logging.Formatter("%(funcName)s at line %(lineno)d: %(message)s"))
 logger = logging.getLogger("arxiv_reader")
-logger.info("___ARXIV_EMAIL_PARSER__!")
+logger.addHandler(log_handler)
+logger.setLevel(log_level)
+logger.debug("___ARXIV_EMAIL_PARSER__!")
+
+
+class ProfileTimer(object):
+    """
+    A context manager which records the time spent in its block.
+    """
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.record(self.name, time.time()-self.start)
+        return False
+
+
+class NullTimer(object):
+    """
+    ProfileTimer of a disabled Profile: does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Profile(object):
+    """
+    Timing of the hot paths (parsing, drawing, key handlers, network
+    fetches) for ${ARXIV_PROFILE}.
+
+    Use it as
+        with profile.timer(name):
+            ...
+    The durations are collected per name (from any thread) and dump()
+    writes their count, total, mean and maximum.  A disabled profile hands
+    out a single NullTimer, so the instrumentation costs next to nothing.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.times = {}
+            # name: [count, total, max]
+        self.lock = threading.Lock()
+        self.null_timer = NullTimer()
+
+    def timer(self, name):
+        if not self.enabled:
+            return self.null_timer
+        return ProfileTimer(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            times = self.times.setdefault(name, [0, 0.0, 0.0])
+            times[0] += 1
+            times[1] += seconds
+            times[2] = max(times[2], seconds)
+
+    def summary(self):
+        """
+        The lines of the summary, the most expensive names first.
+        """
+        with self.lock:
+            times = sorted(self.times.items(), key=lambda item: -item[1][1])
+        lines = ["%-30s %7s %10s %10s %10s"
+                 % ("", "count", "total ms", "mean ms", "max ms")]
+        for (name, (count, total, longest)) in times:
+            lines.append("%-30s %7d %10.2f %10.3f %10.3f"
+                         % (name[:30], count, 1000*total, 1000*total/count,
+                            1000*longest))
+        return lines
+
+    def dump(self, path=None):
+        """
+        Write the summary to the file path (appended), or to stderr.
+        """
+        if not self.times:
+            return
+        text = "".join(line+"\n" for line in self.summary())
+        if path:
+            with open(path, "a") as sock:
+                sock.write(text)
+        else:
+            sys.stderr.write(text)
+
+
+ARXIV_PROFILE = os.getenv("ARXIV_PROFILE")
+    # '1' writes the profile summary to stderr at exit, any other value is
+    # the file to which it is appended.
+profile = Profile(enabled=bool(ARXIV_PROFILE))
+if profile.enabled:
+    atexit.register(profile.dump,
+                    ARXIV_PROFILE != "1" and ARXIV_PROFILE or None)
+
+
+ENTRY_START = '\\\\'
+    # a line which (followed by an 'arXiv:' line) starts a new entry, and
+    # which inside an entry starts the abstract.
+URL_PREFIX = '\\\\ ( http://arxiv.org'
+    # the last line of an entry: '\\ ( http://arxiv.org/abs/XXXX ,  12kb)'
+SEPARATOR_PATTERN = re.compile('-+$')
+WHITESPACE_PATTERN = re.compile('\s+')
+VERSION_PATTERN = re.compile(r'v\d+$')
+    # the version at the end of an arxiv id
+html_unescape = HTMLParser().unescape
+    # replaces the entity and character references of html text
+
+
+class Entry(object):
+    """
+    An entry of a digest.
+
+    The fields are attributes (None when the email does not have them),
+    and an entry is also a mapping from the names of the fields (the
+    columns of the database: 'class' is the msc_class attribute) to their
+    values, e.g. entry.get('title') or dict(entry).  Unlike a dictionary it
+    has no per-entry hash table, which matters on huge digests.
+
+    highlight_cache is (abstract, highlight_class()): the class and the
+    abstract it was computed from, so that it is computed again when the
+    abstract changes; it is not pickled (the patterns can change).
+    """
+
+    FIELDS = ('title', 'authors', 'abstract', 'url', 'comments',
+              'categories', 'class', 'arxiv_nr', 'time', 'date', 'status')
+    ATTRIBUTES = {'class': 'msc_class'}
+        # fields whose attribute has another name
+    __slots__ = ('title', 'authors', 'abstract', 'url', 'comments',
+                 'categories', 'msc_class', 'arxiv_nr', 'time', 'date',
+                 'status', 'highlight_cache')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        for (key, value) in fields.items():
+            self[key] = value
+
+    def _attribute(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return self.ATTRIBUTES.get(key, key)
+
+    def __getitem__(self, key):
+        value = getattr(self, self._attribute(key))
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        setattr(self, self._attribute(key), value)
+
+    def __contains__(self, key):
+        return (key in self.FIELDS
+                and getattr(self, self.ATTRIBUTES.get(key, key)) is not None)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self.FIELDS if key in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__
+                    if name != 'highlight_cache')
+
+    def __setstate__(self, state):
+        self.highlight_cache = None
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
+
+    def __repr__(self):
+        return "Entry(%s)" % ", ".join(
+            "%s=%r" % (self.ATTRIBUTES.get(key, key), self[key])
+            for key in self.keys())
+
+
+class ArXivParser(Message):
+    """
+    This is a simple parser of arXiv emails.
+
+    We are subclassing email.message.Message, since this class is passed as an
+    argument to email.parser.Parser (email_Parser) constructor. Then its
+    parse() method returns ArXivParser instance.
+    """
+    def __init__(self):
+        """
+        sel.data    - list of Entry objects:
+            Entry(title='XXX',
+                  authors='XXX',
+                  abstract='XXX',
+                  url='http://XXX',
+                  comments='XXX',
+                  categories='XXX',
+                  msc_class='XXX',
+                  arxiv_nr='1206.3197',
+                  time=datetime.datetime(...))
+        """
+        Message.__init__(self)
+        self.data = []
+            # will be filled by self.iter_entries() with arxiv content data.
+        self.strings = {}
+            # the categories and classes, which repeat in many entries, are
+            # stored once
+
+    @staticmethod
+    def _parse_time(line):
+        """
+        Parse the 'Date: ' line of an entry.
+        """
+        # first remove the locale dependent info from the time (english names
+        # of the day and the month).
+        time = line[6:35].split()
+        time_str = "%s %s %s %s" % (time[1], time[3], time[4], time[5])
+        return datetime.datetime.strptime(time_str, "%d %Y %H:%M:%S %Z")
+
+    def iter_entries(self):
+        """
+        Parse the arxiv content in a single pass over the email body.
+
+        This is a generator: every entry is appended to self.data and yielded
+        as soon as its last line is read, so the caller can use the first
+        entries before the rest of the email is parsed.  Fields which span
+        several lines (title, authors, comments and the abstract) are
+        collected in lists and joined once.
+        """
+        data = None
+        field = None
+            # (key, lines) of a field which can have continuation lines
+        abstract = None
+            # lines of the abstract (while we are inside it)
+        prev = None
+        for line in email_iterator(self):
+            if line.endswith('\n'):
+                line = line[:-1]
+            if data is None:
+                if not (prev == ENTRY_START and line.startswith('arXiv:')):
+                    prev = line
+                    continue
+                # new entry starts here
+                data = Entry()
+            prev = line
+            if field is not None:
+                if line.startswith(' '):
+                    field[1].append(line)
+                    continue
+                setattr(data, field[0],
+                        WHITESPACE_PATTERN.sub(' ', ' '.join(field[1])))
+                field = None
+            if abstract is not None:
+                if not line.startswith(URL_PREFIX):
+                    abstract.append(line)
+                    continue
+                data.abstract = ' '.join(abstract).strip()
+                abstract = None
+
+            if line.startswith('arXiv:'):
+                # 'arXiv:2410.12345' (or an old style id math/0601001),
+                # maybe with a version or followed by '(*cross-listing*)'
+                fields = line[6:].split()
+                if fields:
+                    data.arxiv_nr = VERSION_PATTERN.sub('', fields[0])
+            elif line.startswith("Date: "):
+                data.time = self._parse_time(line)
+            elif line.startswith("Title: "):
+                field = ('title', [line[7:]])
+            elif line.startswith("Authors: "):
+                field = ('authors', [line[9:]])
+            elif line.startswith("Categories: "):
+                data.categories = self.strings.setdefault(line[12:],
+                                                          line[12:])
+            elif line.startswith("MSC-class: "):
+                data.msc_class = self.strings.setdefault(line[11:],
+                                                         line[11:])
+            elif line.startswith("Comments: "):
+                field = ('comments', [line[10:]])
+            elif line == ENTRY_START:
+                abstract = []
+            elif line.startswith(URL_PREFIX):
+                data.url = line[5:line.index(',')-1]
+                self.data.append(data)
+                yield data
+                data = None
+            elif SEPARATOR_PATTERN.match(line):
+                # an entry without the url line
+                self.data.append(data)
+                yield data
+                data = None
+
+        if data is not None:
+            # the email ended inside an entry
+            if field is not None:
+                setattr(data, field[0],
+                        WHITESPACE_PATTERN.sub(' ', ' '.join(field[1])))
+            self.data.append(data)
+            yield data
+
+    def parse(self):
+        """Parse the whole arxiv content."""
+
+        with profile.timer("parse"):
+            for data in self.iter_entries():
+                pass
+        logger.debug("parsed %d entries", len(self.data))
+
+
+class DigestMerge(object):
+    """
+    The entries of several digests merged into one list, self.data.
+
+    A paper comes again in the next digests as a cross-list or a
+    replacement: merge() looks its arxiv_nr up in a hash index of the
+    entries and the later entry replaces the earlier one at its place (it
+    keeps the abstract of the earlier one if it has none).  So every paper
+    appears once, with the metadata of the last digest.
+    """
+
+    def __init__(self):
+        self.data = []
+        self.index = {}
+            # arxiv_nr: index in self.data
+
+    def merge(self, data):
+        """
+        Add the entry data.  Returns the index of the entry which it
+        replaced, or None if it was appended.
+        """
+        ind = self.index.get(data.arxiv_nr)
+        if ind is None:
+            if data.arxiv_nr:
+                self.index[data.arxiv_nr] = len(self.data)
+            self.data.append(data)
+            return None
+        if not data.abstract:
+            data.abstract = self.data[ind].abstract
+        self.data[ind] = data
+        return ind
+
+    def sort(self, keys):
+        """
+        Sort the entries by keys (keys[ind] is the key of the ind-th entry).
+        """
+        order = sorted(range(len(self.data)), key=keys.__getitem__)
+        self.data[:] = [self.data[ind] for ind in order]
+        self.index = dict((data.arxiv_nr, ind)
+                          for (ind, data) in enumerate(self.data)
+                          if data.arxiv_nr)
+
+
+class AbsPageExtractor(object):
+    """
+    Reads the abstract and the versions (self.version_list = ['v1', 'v2',
+    ...]) from the arxiv web page of a paper.
+
+    The page can be fed in chunks as it arrives from the socket: only the
+    two sections are looked for (the abstract blockquote and the submission
+    history) and feed() returns True as soon as both were read, so the rest
+    of the page does not have to be downloaded.
+    """
+
+    SECTIONS = (
+        ('abstract',
+         re.compile(r'<blockquote[^>]*>\s*<span[^>]*>\s*Abstract:?\s*'
+                    r'</span>', re.IGNORECASE),
+         re.compile(r'</blockquote>', re.IGNORECASE)),
+        ('history',
+         re.compile(r'<h2[^>]*>\s*Submission history\s*</h2>',
+                    re.IGNORECASE),
+         re.compile(r'</div>', re.IGNORECASE)),
+    )
+    VERSION_PATTERN = re.compile(
+        r'<(?:b|strong)>\s*(?:<a\b[^>]*>\s*)?\[(v\d+)\]\s*(?:</a>\s*)?'
+        r'</(?:b|strong)>')
+        # the earlier versions are links: <strong><a href=...>[v1]</a></strong>
+    BREAK_PATTERN = re.compile(r'<(?:br|/?p|/?div|/?li)\b[^>]*>',
+                               re.IGNORECASE)
+        # the tags which separate words: the others (<i>, <sub>, ...) are
+        # inline, 'H<sub>2</sub>O' is 'H2O'
+    TAG_PATTERN = re.compile(r'<[^>]*>')
+    OVERLAP = 256
+        # a tag split between two chunks is searched for again when the
+        # next chunk arrives: no tag we look for is longer than this.
+
+    def __init__(self):
+        self.page = ""
+        self.sections = {}
+            # name: (start, end) offsets of the section in self.page (end is
+            # None until it is found)
+        self.scanned = 0
+            # the length of self.page when the last chunk was searched
+        self.abstract = u""
+        self.version_list = []
+
+    def done(self):
+        return (len(self.sections) == len(self.SECTIONS)
+                and None not in (end for (start, end)
+                                 in self.sections.values()))
+
+    def feed(self, chunk):
+        """
+        Search chunk (the next part of the page).  Returns True when both
+        sections were found.
+        """
+        if self.done():
+            return True
+        since = max(0, self.scanned-self.OVERLAP)
+        self.page += chunk
+        self.scanned = len(self.page)
+        for (name, start_pattern, end_pattern) in self.SECTIONS:
+            (start, end) = self.sections.get(name, (None, None))
+            if start is None:
+                match = start_pattern.search(self.page, since)
+                if match is None:
+                    continue
+                start = match.end()
+            if end is None:
+                match = end_pattern.search(self.page, max(since, start))
+                end = match and match.start()
+            self.sections[name] = (start, end)
+            if end is not None:
+                self._extract(name, self.page[start:end])
+        return self.done()
+
+    def close(self):
+        """
+        The page is complete: a section without its end tag ends with the
+        page.
+        """
+        for (name, (start, end)) in self.sections.items():
+            if end is None:
+                self.sections[name] = (start, len(self.page))
+                self._extract(name, self.page[start:])
+
+    def _extract(self, name, text):
+        if name == 'abstract':
+            text = self.BREAK_PATTERN.sub(' ', text)
+            text = self.TAG_PATTERN.sub('', text).decode("utf8", "replace")
+            self.abstract = WHITESPACE_PATTERN.sub(
+                ' ', html_unescape(text)).strip()
+        else:
+            self.version_list = self.VERSION_PATTERN.findall(text)
+
+
+class ArXivDB(object):
+    """
+    The sqlite3 database of saved papers (${ARXIV_DB}).
+
+    The connection is opened on first use and kept open for the whole
+    session.  The statements are constant strings, so sqlite3 prepares each
+    of them only once (it keeps a statement cache per connection).
+    """
+
+    FIELDS = Entry.FIELDS
+        # the columns of the arxiv table
+    INSERT = """
+        INSERT INTO arxiv
+             (title, authors, abstract, url,
+              comments, categories, class, arxiv_nr,
+              time, date, status)
+        values
+             (:title, :authors, :abstract, :url,
+              :comments, :categories, :class, :arxiv_nr,
+              :time, :date, :status)
+        """
+    DELETE = "DELETE FROM arxiv WHERE arxiv_nr = ?"
+    INSERT_AUTHOR = "INSERT OR IGNORE INTO author (name) VALUES (?)"
+    LINK_AUTHOR = """
+        INSERT OR IGNORE INTO arxiv_author (arxiv_nr, author_id, position)
+        SELECT ?, id, ? FROM author WHERE name = ?
+        """
+    INSERT_CATEGORY = "INSERT OR IGNORE INTO category (name) VALUES (?)"
+    LINK_CATEGORY = """
+        INSERT OR IGNORE INTO arxiv_category (arxiv_nr, category_id)
+        SELECT ?, id FROM category WHERE name = ?
+        """
+    SELECT_SAVED = "SELECT arxiv_nr FROM arxiv WHERE arxiv_nr IN (%s)"
+    SEARCH = """
+        SELECT arxiv.arxiv_nr, arxiv.title, arxiv.authors, arxiv.abstract,
+               arxiv.url, fts.rank
+        FROM (SELECT rowid, rank FROM arxiv_fts
+              WHERE arxiv_fts MATCH ? ORDER BY rank LIMIT ?) AS fts
+        JOIN arxiv ON arxiv.rowid = fts.rowid
+        ORDER BY fts.rank
+        """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.fts = False
+            # is there the full text index
+
+    def connect(self, create=False):
+        """
+        Return the connection.  If the database does not exist return None,
+        or create it with DB_SCHEMA if create is True.
+        """
+        if self.conn is None:
+            # must be checked before sqlite3.connect()
+            db_exists = os.path.exists(self.path)
+            if not db_exists and not create:
+                return None
+            self.conn = sqlite3.connect(self.path)
+            if not db_exists:
+                self.conn.executescript(DB_SCHEMA)
+            self._migrate()
+            self.fts = self._init_fts()
+        return self.conn
+
+    def _migrate(self):
+        """
+        Bring the schema up to date: run the MIGRATIONS which are newer than
+        the version of the database (PRAGMA user_version), each in its own
+        transaction together with the update of the version.
+        """
+        conn = self.conn
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for (version, migration) in enumerate(self.MIGRATIONS[version:],
+                                              version+1):
+            logger.info("migrating %s to version %d", self.path, version)
+            conn.commit()
+            isolation_level = conn.isolation_level
+            conn.isolation_level = None
+                # no implicit commits (before CREATE statements): the
+                # transaction is ours.
+            try:
+                conn.execute("BEGIN")
+                migration(self, conn)
+                conn.execute("PRAGMA user_version = %d" % version)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.isolation_level = isolation_level
+
+    def _migrate_1(self, conn):
+        """
+        Indexes on time, date and status, and the authors and categories in
+        tables of their own (LINKS_SCHEMA).
+        """
+        for statement in sql_statements(LINKS_SCHEMA):
+            conn.execute(statement)
+        self._link(conn, conn.cursor().execute(
+            "SELECT arxiv_nr, authors, categories FROM arxiv"))
+
+    MIGRATIONS = (_migrate_1,)
+        # MIGRATIONS[n] upgrades the schema from version n to n+1.
+
+    def _link(self, conn, rows):
+        """
+        Fill the author and category link tables for rows: (arxiv_nr,
+        authors, categories) of saved papers.
+        """
+        for (arxiv_nr, authors, categories) in rows:
+            for (position, name) in enumerate(split_authors(authors)):
+                conn.execute(self.INSERT_AUTHOR, (name,))
+                conn.execute(self.LINK_AUTHOR, (arxiv_nr, position, name))
+            for name in (categories or "").split():
+                conn.execute(self.INSERT_CATEGORY, (name,))
+                conn.execute(self.LINK_CATEGORY, (arxiv_nr, name))
+
+    def _init_fts(self):
+        """
+        Create the full text index (FTS_SCHEMA) if it does not exist yet.
+        Returns False if sqlite3 was built without fts5.
+        """
+        if self.conn.execute("SELECT name FROM sqlite_master "
+                             "WHERE name = 'arxiv_fts'").fetchone():
+            return True
+        try:
+            self.conn.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            logger.warning("no full text search: %s", e)
+            self.conn.rollback()
+            return False
+        return True
+
+    def search(self, query, limit=200):
+        """
+        Full text search of title, authors, abstract and comments.  Returns
+        a list of rows (arxiv_nr, title, authors, abstract, url, rank) ranked
+        by bm25 (best first), or None if there is no full text index.
+
+        The query uses the fts5 syntax; if it is not valid its words are
+        searched for as they are.
+        """
+        conn = self.connect()
+        if conn is None or not self.fts:
+            return None
+        try:
+            return conn.execute(self.SEARCH, (query, limit)).fetchall()
+        except sqlite3.OperationalError:
+            query = " ".join('"%s"' % word.replace('"', '""')
+                             for word in query.split())
+            return conn.execute(self.SEARCH, (query, limit)).fetchall()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def saved(self, arxiv_nrs, chunk=500):
+        """
+        Return the set of those arxiv_nrs which are saved in the database.
+
+        The database is queried once for every chunk of arxiv_nrs (with an
+        IN list of at most chunk values, which keeps it below sqlite's limit
+        of host parameters).
+        """
+        saved = set()
+        conn = self.connect()
+        if conn is None:
+            return saved
+        arxiv_nrs = [nr for nr in arxiv_nrs if nr]
+        for start in range(0, len(arxiv_nrs), chunk):
+            nrs = arxiv_nrs[start:start+chunk]
+            rows = conn.execute(self.SELECT_SAVED % ",".join("?"*len(nrs)),
+                                nrs)
+            saved.update(row[0] for row in rows)
+        return saved
+
+    def save(self, entries):
+        """
+        Insert entries (Entries as in ArXivParser.data), and their authors
+        and categories in the link tables, in one transaction.  Returns
+        (written, present): the arxiv_nr's of the entries which were
+        written and of those which were already saved.
+        """
+        conn = self.connect(create=True)
+        present = self.saved([d.arxiv_nr for d in entries])
+        written = []
+        rows = []
+        for data in entries:
+            arxiv_nr = data.arxiv_nr
+            if arxiv_nr in present or arxiv_nr in written:
+                continue
+            written.append(arxiv_nr)
+            rows.append(dict((f, data.get(f, "")) for f in self.FIELDS))
+        with conn:
+            conn.executemany(self.INSERT, rows)
+            self._link(conn, [(row['arxiv_nr'], row['authors'],
+                               row['categories']) for row in rows])
+        return (written,
+                [d.arxiv_nr for d in entries if d.arxiv_nr in present])
+
+    def delete(self, arxiv_nrs):
+        """
+        Delete arxiv_nrs in one transaction.  Returns the list of those
+        which were in the database.
+        """
+        present = self.saved(arxiv_nrs)
+        if present:
+            with self.conn:
+                self.conn.executemany(self.DELETE,
+                                      [(nr,) for nr in present])
+        return [nr for nr in arxiv_nrs if nr in present]
+
+    def select(self, since=None, until=None, status=None, category=None,
+               author=None, arxiv_nrs=None):
+        """
+        Yield the saved papers (dictionaries of self.FIELDS) added to the
+        database between the dates since and until (strings YYYY-MM-DD,
+        both included), with the given status, whose categories include
+        category and whose authors include author, and which are among
+        arxiv_nrs (at most a few hundred of them), in the order in which
+        they were added.  None is no condition.
+
+        The rows are read from the cursor one at a time, so the memory does
+        not depend on the size of the database.
+        """
+        conn = self.connect()
+        if conn is None:
+            return
+        (conditions, params) = ([], [])
+        if since:
+            conditions.append("date >= ?")
+            params.append(since)
+        if until:
+            conditions.append("date <= ?")
+            params.append(until)
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if category:
+            conditions.append(
+                "arxiv_nr IN (SELECT arxiv_nr FROM arxiv_category "
+                "JOIN category ON category.id = category_id "
+                "WHERE category.name = ?)")
+            params.append(category)
+        if author:
+            conditions.append(
+                "arxiv_nr IN (SELECT arxiv_nr FROM arxiv_author "
+                "JOIN author ON author.id = author_id "
+                "WHERE author.name LIKE ?)")
+            params.append("%%%s%%" % author)
+        if arxiv_nrs is not None:
+            arxiv_nrs = list(arxiv_nrs)
+            conditions.append("arxiv_nr IN (%s)"
+                              % ",".join("?"*len(arxiv_nrs)))
+            params.extend(arxiv_nrs)
+        query = "SELECT %s FROM arxiv" % ", ".join(self.FIELDS)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY rowid"
+        for row in conn.execute(query, params):
+            yield dict(zip(self.FIELDS, row))
+
+
+class SeenPapers(object):
+    """
+    The arxiv_nr's of the papers whose details were viewed, in a sqlite3
+    database (${ARXIV_SEEN_DB}) of its own, so that viewing papers does not
+    create ${ARXIV_DB}.
+
+    The table has no rowid, so it is just the b-tree of the arxiv_nr's:
+    seen() looks up the entries of a digest in one query per chunk (as
+    ArXivDB.saved() does).  If the database cannot be opened no paper is
+    seen.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS seen (
+            arxiv_nr    text primary key,
+            date        date
+        ) WITHOUT ROWID;
+        """
+    SELECT = "SELECT arxiv_nr FROM seen WHERE arxiv_nr IN (%s)"
+    INSERT = "INSERT OR IGNORE INTO seen (arxiv_nr, date) VALUES (?, ?)"
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.broken = False
+
+    def connect(self):
+        """
+        Return the connection (None if the database cannot be opened).
+        """
+        if self.conn is None and not self.broken:
+            try:
+                directory = os.path.dirname(self.path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self.conn = sqlite3.connect(self.path)
+                self.conn.executescript(self.SCHEMA)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("cannot open %s: %s", self.path, e)
+                self.conn = None
+                self.broken = True
+        return self.conn
+
+    def seen(self, arxiv_nrs, chunk=500):
+        """
+        Return the set of those arxiv_nrs which were seen.
+        """
+        seen = set()
+        conn = self.connect()
+        if conn is None:
+            return seen
+        arxiv_nrs = [nr for nr in arxiv_nrs if nr]
+        for start in range(0, len(arxiv_nrs), chunk):
+            nrs = arxiv_nrs[start:start+chunk]
+            rows = conn.execute(self.SELECT % ",".join("?"*len(nrs)), nrs)
+            seen.update(row[0] for row in rows)
+        return seen
+
+    def add(self, arxiv_nr):
+        conn = self.connect()
+        if conn is None or not arxiv_nr:
+            return
+        with conn:
+            conn.execute(self.INSERT, (arxiv_nr, datetime.date.today()))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class RelevanceModel(object):
+    """
+    A tf-idf model of the papers saved in the database (their titles and
+    abstracts), which scores entries by the cosine similarity of their
+    tf-idf vectors with the profile of the saved papers.
+
+    For every term the model keeps the number of saved papers which contain
+    it (self.df) and the sum of its frequencies in them (self.tf, the terms
+    of every paper sum up to 1).  The profile is the sparse vector
+    tf[term]*idf(term), so a paper is added or removed by updating the
+    counts of its terms, and scoring an entry only looks at the terms of
+    the entry.  The model is pickled to ${ARXIV_MODEL} and brought up to
+    date with the database by sync().
+    """
+
+    TERM_PATTERN = re.compile(r"[^\W\d_][\w\-]+", re.UNICODE)
+    STOPWORDS = frozenset("""
+        the and for are that this with from which these those their there
+        then than its our can also has have not but all any some such
+        into over under where when what how show shows prove proves give
+        gives paper we us is be by of on in an as at or to
+        """.split())
+
+    def __init__(self):
+        self.papers = set()
+            # arxiv_nr's of the papers in the model
+        self.df = {}
+        self.tf = {}
+        self.changed = False
+            # not stored since it was changed
+        self.norm = None
+        self.weights = None
+            # the norm of the profile and {term: (idf, tf*idf)} (computed
+            # when they are needed)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read the model stored in path; a new one if it cannot be read.
+        """
+        model = cls()
+        try:
+            with open(path, "rb") as sock:
+                (model.papers, model.df, model.tf) = cPickle.load(sock)
+        except Exception as e:
+            if os.path.exists(path):
+                logger.warning("cannot read %s: %s", path, e)
+            model = cls()
+        return model
+
+    def store(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = "%s.%d" % (path, os.getpid())
+        with open(tmp, "wb") as sock:
+            cPickle.dump((self.papers, self.df, self.tf), sock,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+        self.changed = False
+
+    @classmethod
+    def terms(cls, title, abstract):
+        """
+        {term: count} of a title and an abstract.
+        """
+        counts = {}
+        for term in cls.TERM_PATTERN.findall(
+                (u"%s %s" % (title or "", abstract or "")).lower()):
+            if len(term) > 2 and term not in cls.STOPWORDS:
+                counts[term] = counts.get(term, 0)+1
+        return counts
+
+    def _update(self, arxiv_nr, title, abstract, sign):
+        counts = self.terms(title, abstract)
+        total = float(sum(counts.values())) or 1.0
+        for (term, count) in counts.items():
+            df = self.df.get(term, 0)+sign
+            tf = self.tf.get(term, 0.0)+sign*count/total
+            if df > 0:
+                self.df[term] = df
+                self.tf[term] = tf
+            else:
+                self.df.pop(term, None)
+                self.tf.pop(term, None)
+        self.changed = True
+        self.norm = None
+        self.weights = None
+
+    def add(self, arxiv_nr, title, abstract):
+        if arxiv_nr in self.papers:
+            return
+        self.papers.add(arxiv_nr)
+        self._update(arxiv_nr, title, abstract, 1)
+
+    def remove(self, arxiv_nr, title, abstract):
+        """
+        Remove a paper: title and abstract must be those which it was added
+        with (the ones in the database).
+        """
+        if arxiv_nr not in self.papers:
+            return
+        self.papers.discard(arxiv_nr)
+        self._update(arxiv_nr, title, abstract, -1)
+
+    def sync(self, db):
+        """
+        Add the papers saved in db (an ArXivDB) which are not in the model.
+        If papers were removed from db the model is built again.
+        """
+        conn = db.connect()
+        saved = set()
+        if conn is not None:
+            saved.update(row[0]
+                         for row in conn.execute("SELECT arxiv_nr FROM arxiv"))
+        if self.papers - saved:
+            self.papers = set()
+            self.df = {}
+            self.tf = {}
+            self.changed = True
+            self.norm = None
+            self.weights = None
+        added = saved - self.papers
+        if not added:
+            return
+        papers = db.select(arxiv_nrs=len(added) <= 500 and added or None)
+        for paper in papers:
+            self.add(paper['arxiv_nr'], paper['title'], paper['abstract'])
+
+    def idf(self, term):
+        return math.log((1.0+len(self.papers))/(1+self.df.get(term, 0)))+1
+
+    def score(self, title, abstract):
+        """
+        The cosine similarity (from 0 to 1) of a title and an abstract with
+        the saved papers.
+        """
+        if not self.papers:
+            return 0.0
+        if self.weights is None:
+            self.weights = dict((term, (self.idf(term), tf*self.idf(term)))
+                                for (term, tf) in self.tf.items())
+            self.norm = math.sqrt(sum(weight*weight for (idf, weight)
+                                      in self.weights.values()))
+        unknown = (self.idf(None), 0.0)
+            # the idf of a term which no saved paper has
+        (dot, norm) = (0.0, 0.0)
+        for (term, count) in self.terms(title, abstract).items():
+            (idf, profile) = self.weights.get(term, unknown)
+            weight = count*idf
+            norm += weight*weight
+            dot += weight*profile
+        if not norm or not self.norm:
+            return 0.0
+        return dot/math.sqrt(norm)/self.norm
+
+    def scores(self, entries):
+        """
+        The score() of every entry (Entries).
+        """
+        return [self.score(data.title, data.abstract) for data in entries]
+
+
+class FetchError(IOError):
+    """
+    A request of HTTPEngine failed (a network error, a timeout or an
+    unexpected HTTP status).
+    """
+
+
+class EngineResponse(object):
+    """
+    A response of HTTPEngine.open().  It holds one of the engine's
+    connections until close(): a fully read response gives the connection
+    back to the engine for the next request to the same host.
+    """
+
+    def __init__(self, engine, key, conn, response):
+        self.engine = engine
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            return self.response.read(amt)
+        except httplib.HTTPException as e:
+            raise FetchError("reading from %s: %r" % (self.key[1], e))
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.engine._checkin(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+        self.engine.slots.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class HTTPEngine(object):
+    """
+    The HTTP client of all network accesses (arxiv pages and pdfs).
+
+    Connections are kept alive and reused for the next request to the same
+    host (or proxy, see ${http_proxy}), every socket operation times out
+    after self.timeout seconds, and at most max_connections requests run at
+    the same time: the threads which fetch in the background (see
+    AbstractPrefetcher and PDFDownloads) share these connections and wait
+    for a free one.  Redirects are followed.
+    """
+
+    REDIRECTS = (301, 302, 303, 307, 308)
+    STALE_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+        # what a request on a connection closed by the server fails with
+
+    def __init__(self, max_connections=ARXIV_CONNECTIONS,
+                 timeout=ARXIV_TIMEOUT, max_redirects=5):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.idle = {}
+            # key: connections which are kept alive
+        self.lock = threading.Lock()
+        self.proxies = urllib.getproxies()
+
+    def _route(self, url):
+        """
+        Return (key, target): the connection for url, as (scheme, host,
+        port, tunnel), and the target of the request line.
+        """
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme
+        host = parts.hostname
+        port = parts.port or (scheme == 'https' and 443 or 80)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        proxy = self.proxies.get(scheme)
+        if proxy and not urllib.proxy_bypass(host):
+            proxy = urlparse.urlsplit(proxy)
+            if scheme == 'https':
+                # a tunnel (CONNECT) through the proxy
+                return (('https', proxy.hostname, proxy.port or 80,
+                         (host, port)), target)
+            return (('http', proxy.hostname, proxy.port or 80, None), url)
+        return ((scheme, host, port, None), target)
+
+    def _checkout(self, key):
+        """
+        Return (connection, reused).
+        """
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return (idle.pop(), True)
+        (scheme, host, port, tunnel) = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+        if tunnel:
+            conn.set_tunnel(*tunnel)
+        return (conn, False)
+
+    def _checkin(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_connections:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _request(self, url, headers):
+        (key, target) = self._route(url)
+        self.slots.acquire()
+        try:
+            while True:
+                (conn, reused) = self._checkout(key)
+                try:
+                    conn.request("GET", target, headers=headers)
+                    response = conn.getresponse()
+                except (socket.error, httplib.HTTPException) as e:
+                    conn.close()
+                    if reused and self._stale(e):
+                        # the server closed the idle connection, try a new
+                        # one
+                        continue
+                    raise FetchError("GET %s: %s" % (url, e))
+                return EngineResponse(self, key, conn, response)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def _stale(self, error):
+        """
+        Whether error (of a request on a reused connection) means that the
+        server had closed the connection.  A timeout does not: the request
+        is not tried again, it would only wait as long once more.
+        """
+        if isinstance(error, (httplib.BadStatusLine,
+                              httplib.CannotSendRequest)):
+            return True
+        return (isinstance(error, socket.error)
+                and not isinstance(error, socket.timeout)
+                and error.errno in self.STALE_ERRNOS)
+
+    def open(self, url, headers=None):
+        """
+        Send a GET request for url (following redirects) and return the
+        EngineResponse, whatever its status is.  It must be closed (it is a
+        context manager).  Raises FetchError.
+        """
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', "arxiv_reader")
+        for _ in range(self.max_redirects+1):
+            response = self._request(url, headers)
+            location = response.getheader('Location')
+            if response.status not in self.REDIRECTS or not location:
+                return response
+            with response:
+                response.read()
+            url = urlparse.urljoin(url, location)
+        raise FetchError("too many redirects: %s" % url)
+
+    def close(self):
+        """
+        Close the idle connections.
+        """
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+http_engine = HTTPEngine()
+
+
+class HTTPCache(object):
+    """
+    On-disk cache of web pages.
+
+    Every url is stored in two files named by the sha1 hash of the url: the
+    page itself and a json file with the url, the time when it was fetched,
+    its ETag and Last-Modified headers and whether only the beginning of the
+    page was read (see get()).  A page younger than ttl seconds is used as
+    it is, an older one is revalidated with a conditional request.  The
+    modification time of a page is updated whenever it is used, and when the
+    cache grows above max_size bytes the least recently used pages are
+    removed.
+    """
+
+    def __init__(self, directory, ttl=ARXIV_CACHE_TTL,
+                 max_size=ARXIV_CACHE_SIZE, engine=None):
+        self.directory = directory
+        self.engine = engine or http_engine
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.size = None
+            # the size of all pages, computed on the first store
+
+    def _path(self, url):
+        return os.path.join(self.directory,
+                            hashlib.sha1(url.encode("utf8")).hexdigest())
+
+    def _load(self, url):
+        """
+        Return (meta, page) of a cached url or (None, None).
+        """
+        path = self._path(url)
+        try:
+            with open(path+".json") as sock:
+                meta = json.load(sock)
+            with open(path, "rb") as sock:
+                page = sock.read()
+        except (IOError, ValueError):
+            return (None, None)
+        if meta.get('url') != url:
+            return (None, None)
+        return (meta, page)
+
+    def _touch(self, url):
+        try:
+            os.utime(self._path(url), None)
+        except OSError:
+            pass
+
+    def _write(self, path, content):
+        tmp = "%s.%d.%s" % (path, os.getpid(), threading.current_thread().name)
+        with open(tmp, "wb") as sock:
+            sock.write(content)
+        os.rename(tmp, path)
+
+    def _store(self, url, meta, page=None):
+        """
+        Write meta (and the page, unless it is None) and remove the least
+        recently used pages if the cache is too big.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(url)
+        with self.lock:
+            if page is not None:
+                if self.size is None:
+                    self.size = sum(size for (atime, size, p) in self._pages())
+                elif os.path.exists(path):
+                    self.size -= os.path.getsize(path)
+                self._write(path, page)
+                self.size += len(page)
+            self._write(path+".json", json.dumps(meta))
+            if self.size is not None and self.size > self.max_size:
+                self._evict()
+
+    def _pages(self):
+        """
+        (mtime, size, path) of all cached pages.
+        """
+        pages = []
+        for name in os.listdir(self.directory):
+            if len(name) != 40:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            pages.append((stat.st_mtime, stat.st_size, path))
+        return pages
+
+    def _evict(self):
+        pages = sorted(self._pages())
+        self.size = sum(size for (mtime, size, path) in pages)
+        for (mtime, size, path) in pages:
+            if self.size <= self.max_size:
+                break
+            for name in (path, path+".json"):
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+            self.size -= size
+            logger.debug("cache: removed %s", path)
+
+    def get(self, url, consume=None, chunk_size=16*1024):
+        """
+        Return the page at url, from the cache if possible.  Raises IOError
+        if the page cannot be read.
+
+        If consume is given it is called with the page, or with its chunks
+        as they are downloaded; when it returns True the rest of the page is
+        not downloaded, and only the part which was read is returned (and
+        cached, marked as partial).  A partial page is only given to a
+        consumer: if it does not return True the page is downloaded again
+        and the consumer gets what follows the part it has seen, and a call
+        without a consumer always downloads the whole page.
+        """
+        (meta, page) = self._load(url)
+        now = time.time()
+        partial = meta is not None and meta.get('partial', False)
+        seen = 0
+            # the length of the beginning of the page given to consume
+        if meta is not None and now - meta['time'] < self.ttl:
+            if not partial:
+                self._touch(url)
+                if consume:
+                    consume(page)
+                return page
+            if consume:
+                self._touch(url)
+                if consume(page):
+                    return page
+                seen = len(page)
+        headers = {}
+        if meta is not None and not partial:
+            # a partial page is not revalidated: a 304 would keep it partial
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        stopped = False
+        with profile.timer("fetch"):
+            with self.engine.open(url, headers) as response:
+                if consume and response.status == 200:
+                    chunks = []
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        chunks.append(chunk)
+                        if seen >= len(chunk):
+                            seen -= len(chunk)
+                            continue
+                        (chunk, seen) = (chunk[seen:], 0)
+                        if consume(chunk):
+                            stopped = True
+                            break
+                    body = "".join(chunks)
+                else:
+                    body = response.read()
+        if response.status == 304 and meta is not None:
+            meta['time'] = now
+            self._store(url, meta)
+            self._touch(url)
+            if consume:
+                consume(page)
+            return page
+        if response.status != 200:
+            raise FetchError("GET %s: HTTP %d" % (url, response.status))
+        self._store(url,
+                    {'url': url,
+                     'time': now,
+                     'etag': response.getheader('ETag'),
+                     'last_modified': response.getheader('Last-Modified'),
+                     'partial': stopped},
+                    body)
+        return body
+
+http_cache = HTTPCache(ARXIV_CACHE)
+
+
+class DigestCache(object):
+    """
+    A cache of parsed digests: the entries (ArXivParser.data) of an email
+    are pickled to a file named by the sha1 of the raw email, so that
+    opening the same email again does not parse it.  The entries are
+    stored again when abstracts were fetched for them.
+
+    Digests which were not opened for max_age seconds are removed, and so
+    are the least recently opened ones when all of them take more than
+    max_size bytes.
+    """
+
+    def __init__(self, directory, max_age=ARXIV_DIGEST_DAYS*24*60*60,
+                 max_size=ARXIV_DIGEST_CACHE_SIZE):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_size = max_size
+
+    @staticmethod
+    def key(message):
+        """
+        The key of a raw (not decoded) email.
+        """
+        return hashlib.sha1(message).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key+".pickle")
+
+    def load(self, key):
+        """
+        Return the cached entries, or None.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as sock:
+                data = cPickle.load(sock)
+            os.utime(path, None)
+            if data and isinstance(data[0], dict):
+                # stored before the entries were Entry objects
+                data = [Entry(**entry) for entry in data]
+        except Exception as e:
+            # a missing file, or a broken one (unpickling raises all kinds
+            # of errors)
+            if os.path.exists(path):
+                logger.warning("cannot read %s: %s", path, e)
+            return None
+        return data
+
+    def store(self, key, data):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(key)
+        tmp = "%s.%d" % (path, os.getpid())
+        with open(tmp, "wb") as sock:
+            cPickle.dump(data, sock, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+        self._evict()
+
+    def _evict(self):
+        digests = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pickle"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            digests.append((stat.st_mtime, stat.st_size, path))
+        digests.sort()
+        size = sum(size for (mtime, size, path) in digests)
+        too_old = time.time()-self.max_age
+        for (mtime, size_, path) in digests:
+            if mtime >= too_old and size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= size_
+            logger.debug("digest cache: removed %s", path)
+
+
+digest_cache = DigestCache(os.path.join(ARXIV_CACHE, "digests"))
+
+
+class PaperMetadata(object):
+    """
+    Metadata of a paper read from its arxiv web page or from the arxiv API.
+    """
+
+    def __init__(self, arxiv_nr, versions, abstract):
+        self.arxiv_nr = arxiv_nr
+        self.versions = versions
+            # ['v1', 'v2', ...]
+        self.abstract = abstract
+        self.fetched = datetime.datetime.now()
+
+
+class ArXivAPI(object):
+    """
+    Client of the arxiv API (${ARXIV_API}): the metadata of many papers is
+    read with one query (an id_list) for every batch of papers.
+
+    The Atom feed is parsed while it is read, and every entry of it becomes
+    a PaperMetadata: the abstract is its summary and the versions are v1 up
+    to the version of its id (the feed has only the latest one).  The url
+    can point to any server which answers with such feeds.
+    """
+
+    ATOM = "{http://www.w3.org/2005/Atom}"
+    ID_PATTERN = re.compile(r'/abs/(.+?)(?:v(\d+))?$')
+        # the id of an entry: http://arxiv.org/abs/1206.3197v2 (the ids of
+        # errors do not match)
+
+    def __init__(self, url=ARXIV_API, batch=ARXIV_API_BATCH, engine=None):
+        self.url = url
+        self.batch = batch
+        self.engine = engine or http_engine
+
+    def query_url(self, arxiv_nrs):
+        return "%s?%s" % (self.url,
+                          urllib.urlencode({'id_list': ",".join(arxiv_nrs),
+                                            'max_results': len(arxiv_nrs)}))
+
+    def lookup(self, arxiv_nrs):
+        """
+        Return the list of PaperMetadata of those arxiv_nrs which the API
+        knows about, querying it once for every self.batch of them.  Raises
+        IOError.
+        """
+        records = []
+        for start in range(0, len(arxiv_nrs), self.batch):
+            records.extend(self._query(arxiv_nrs[start:start+self.batch]))
+        return records
+
+    def _query(self, arxiv_nrs):
+        url = self.query_url(arxiv_nrs)
+        records = []
+        with profile.timer("api"):
+            with self.engine.open(url) as response:
+                if response.status != 200:
+                    raise FetchError("GET %s: HTTP %d"
+                                     % (url, response.status))
+                try:
+                    for (event, elem) in ElementTree.iterparse(response):
+                        if elem.tag == self.ATOM+"entry":
+                            record = self._record(elem)
+                            if record is not None:
+                                records.append(record)
+                            elem.clear()
+                except SyntaxError as e:
+                    # ElementTree.ParseError
+                    raise FetchError("GET %s: %s" % (url, e))
+        return records
+
+    def _record(self, elem):
+        match = self.ID_PATTERN.search(elem.findtext(self.ATOM+"id") or "")
+        if match is None:
+            return None
+        versions = ["v%d" % n
+                    for n in range(1, int(match.group(2) or 1)+1)]
+        abstract = WHITESPACE_PATTERN.sub(
+            ' ', elem.findtext(self.ATOM+"summary") or "").strip()
+        return PaperMetadata(match.group(1), versions, abstract)
+
+
+class MetadataStore(object):
+    """
+    PaperMetadata of every paper looked up in this session.
+
+    The arxiv web page of a paper is fetched (through the cache) and parsed
+    only once, the next lookups of the same arxiv_nr return the same record.
+    If a page is being fetched by another thread, get() waits for it rather
+    than fetching it again.  get_many() looks up many papers at once with
+    the arxiv API (self.api, an ArXivAPI, or None).
+    """
+
+    def __init__(self, cache, api=None):
+        self.cache = cache
+        self.api = api
+        self.records = {}
+        self.fetching = set()
+            # arxiv_nr's whose web pages are being read
+        self.querying = set()
+            # arxiv_nr's being looked up with the API: get() does not wait
+            # for them, a single page is quicker than a whole batch
+        self.cond = threading.Condition()
+
+    def get(self, arxiv_nr, url):
+        """
+        Return the PaperMetadata of arxiv_nr, reading it from url if it is
+        not known yet.  Raises IOError if the page cannot be read.
+        """
+        with self.cond:
+            while arxiv_nr in self.fetching:
+                self.cond.wait()
+            if arxiv_nr in self.records:
+                return self.records[arxiv_nr]
+            self.fetching.add(arxiv_nr)
+        try:
+            extractor = AbsPageExtractor()
+            self.cache.get(url, extractor.feed)
+            extractor.close()
+            record = PaperMetadata(arxiv_nr, extractor.version_list,
+                                   extractor.abstract)
+            with self.cond:
+                self.records[arxiv_nr] = record
+        finally:
+            with self.cond:
+                self.fetching.discard(arxiv_nr)
+                self.cond.notify_all()
+        return record
+
+    def get_many(self, arxiv_nrs):
+        """
+        Return a dictionary {arxiv_nr: PaperMetadata} of arxiv_nrs; those
+        which are not known yet are looked up with the arxiv API (the ones
+        which it does not know about are left out).  Raises IOError.
+        """
+        with self.cond:
+            missing = []
+            if self.api is not None:
+                missing = [nr for nr in set(arxiv_nrs)
+                           if nr and nr not in self.records
+                           and nr not in self.fetching
+                           and nr not in self.querying]
+            self.querying.update(missing)
+        try:
+            if missing:
+                records = self.api.lookup(missing)
+                with self.cond:
+                    for record in records:
+                        self.records.setdefault(record.arxiv_nr, record)
+        finally:
+            with self.cond:
+                self.querying.difference_update(missing)
+                self.cond.notify_all()
+        with self.cond:
+            while any(nr in self.fetching for nr in arxiv_nrs):
+                self.cond.wait()
+            return dict((nr, self.records[nr]) for nr in arxiv_nrs
+                        if nr in self.records)
+
+
+papers = MetadataStore(http_cache,
+                       ARXIV_API_BATCH and ArXivAPI(ARXIV_API) or None)
+
+
+def fetch_abstract(data):
+    """
+    Read the abstract of data (an Entry) from its arxiv web page.  Returns
+    None if the page cannot be read.
+    """
+    try:
+        return papers.get(data.arxiv_nr, data.url).abstract
+    except IOError as e:
+        logger.warning("Cannot connect with %s: %s", data.url, e)
+        return None
+
 
+def fetch_abstracts(entries):
+    """
+    Read the abstracts of entries (a list of Entries) with the arxiv API
+    (see MetadataStore.get_many()), and those which it does not return
+    from the web pages of the papers.  Yields the abstracts in the order of
+    entries (None where it cannot be read): first those which the API
+    returned, and then every other one as soon as its page is read.
+    """
+    try:
+        records = papers.get_many([data.arxiv_nr for data in entries])
+    except IOError as e:
+        logger.warning("arxiv API: %s", e)
+        records = {}
+    for data in entries:
+        record = records.get(data.arxiv_nr)
+        if record is not None and record.abstract:
+            yield record.abstract
+        else:
+            yield fetch_abstract(data)
 
-class ArXivEnd(StandardError):
-    pass
 
+class AbstractPrefetcher(object):
+    """
+    A bounded pool of threads which fetch the abstracts missing from the
+    email in the background.
+
+    The pending entries are kept in a sorted list of their indexes.  A worker
+    takes the first batch pending entries at or below the focus (the first
+    visible entry, see focus()), and only when there are not enough it goes
+    above it.  So the visible entries are fetched first, and moving the
+    cursor reorders the work by just moving the focus.
+
+    Fetched abstracts are put on the self.done queue as (ind, abstract)
+    pairs: curses is not thread safe, so it is the main loop which stores
+    them in the data and redraws the titles.
+    """
+
+    def __init__(self, fetch, workers=4, batch=1):
+        self.fetch = fetch
+            # function: list of args -> iterable of their abstracts (or
+            # None's); every entry is done as soon as its abstract comes
+        self.workers = workers
+        self.batch = max(1, batch)
+        self.cond = threading.Condition()
+        self.pending = []
+        self.args = {}
+        self.running = set()
+        self.first = 0
+        self.stopped = False
+        self.threads = []
+        self.done = Queue.Queue()
+
+    def start(self, jobs):
+        """
+        Add jobs, an iterable of (ind, arg) pairs, and start the workers
+        which will call self.fetch() with lists of at most self.batch args.
+        """
+        if not self.workers:
+            return
+        with self.cond:
+            for (ind, arg) in jobs:
+                if ind not in self.args and ind not in self.running:
+                    bisect.insort(self.pending, ind)
+                    self.args[ind] = arg
+            self.cond.notify_all()
+            n = min(self.workers, len(self.pending))
+        while len(self.threads) < n:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def focus(self, ind):
+        """
+        Fetch entries starting from ind first.
+        """
+        with self.cond:
+            self.first = ind
+
+    def cancel(self, ind):
+        """
+        Remove ind from the pending entries.  Returns False if it is being
+        fetched right now.
+        """
+        with self.cond:
+            pos = bisect.bisect_left(self.pending, ind)
+            if pos < len(self.pending) and self.pending[pos] == ind:
+                del self.pending[pos]
+                del self.args[ind]
+            return ind not in self.running
+
+    def busy(self):
+        with self.cond:
+            return bool(self.pending or self.running)
+
+    def stop(self):
+        """
+        Drop all pending entries and let the workers exit.
+        """
+        with self.cond:
+            self.stopped = True
+            del self.pending[:]
+            self.args.clear()
+            self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                pos = bisect.bisect_left(self.pending, self.first)
+                pos = max(0, min(pos, len(self.pending)-self.batch))
+                inds = self.pending[pos:pos+self.batch]
+                del self.pending[pos:pos+self.batch]
+                args = [self.args.pop(ind) for ind in inds]
+                self.running.update(inds)
+            try:
+                for (ind, abstract) in itertools.izip(inds,
+                                                      self.fetch(args)):
+                    if abstract:
+                        self.done.put((ind, abstract))
+                    with self.cond:
+                        self.running.discard(ind)
+                        self.cond.notify_all()
+            except Exception:
+                logger.exception("fetching %r", args)
+            finally:
+                with self.cond:
+                    self.running.difference_update(inds)
+                    self.cond.notify_all()
+
+
+def download_pdf(url, target, progress=None, chunk_size=64*1024):
+    """
+    Download url to the file target.
 
-class ArXivEntryEnd(StandardError):
-    pass
+    The file is streamed in chunks to target.part, which is renamed to
+    target only when it is complete.  If target.part already exists (an
+    interrupted download) it is resumed with an HTTP Range request.
+    progress(done, total) is called after every chunk (total is None if the
+    server did not send the length).  Raises IOError.
+    """
+    part = target+".part"
+    offset = os.path.exists(part) and os.path.getsize(part) or 0
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+    sock = http_engine.open(url, headers)
+    if sock.status == 416 and offset:
+        # the range is not satisfiable, start from scratch
+        sock.close()
+        os.remove(part)
+        return download_pdf(url, target, progress, chunk_size)
+    try:
+        if sock.status not in (200, 206):
+            raise FetchError("GET %s: HTTP %d" % (url, sock.status))
+        if offset and sock.status != 206:
+            # the server ignored the range
+            offset = 0
+        length = sock.getheader('Content-Length')
+        total = length and int(length)+offset or None
+        done = offset
+        with open(part, offset and "ab" or "wb") as out:
+            while True:
+                chunk = sock.read(chunk_size)
+                if not chunk:
+                    break
+                out.write(chunk)
+                done += len(chunk)
+                if progress:
+                    progress(done, total)
+    finally:
+        sock.close()
+    if total is not None and done < total:
+        raise IOError("incomplete download of %s (%d of %d bytes)"
+                      % (url, done, total))
+    os.rename(part, target)
 
 
-class ArXivParser(Message):
+class PDFDownloads(object):
     """
-    This is a simple parser of arXiv emails.
+    Downloads running in background threads (see download_pdf()).
 
-    We are subclassing email.message.Message, since this class is passed as an
-    argument to email.parser.Parser (email_Parser) constructor. Then its
-    parse() method returns ArXivParser instance.
+    The progress is reported as messages put on self.messages: curses is
+    not thread safe, so it is the main loop which prints them on the status
+    line.
     """
+
     def __init__(self):
+        self.active = set()
+            # targets being downloaded
+        self.lock = threading.Lock()
+        self.messages = Queue.Queue()
+
+    def start(self, url, target, callback=None):
         """
-        sel.data    - list of dictionaries:
-            { 'title'       : 'XXX',
-              'authors'     : 'XXX',
-              'abstract'    : 'XXX',
-              'url'         : 'http://XXX',
-              'comments'    : 'XXX',
-              'categories'  : 'XXX',
-              'class'       : 'XXX' ,
-              'arxiv_nr'    : '1206.3197',
-              'date'        : of the type: datetime.datetime.now() }
+        Download url to target in a new thread, and then call
+        callback(target) (in that thread).  Returns False if target is
+        already being downloaded.
         """
-        Message.__init__(self)
-        self.message = []
-            # will be filled by self.parse() method using: email_iterator(self)
-        self.__len = 0
-        self.data = []
-            # will be filled by self.parse() method with arxiv content data.
-        self.ind = 0
-
-    def __next_entry(self):
-        logger.info("__next_entry: start pos (%d)" % self.ind)
-        while (self.ind < self.__len
-               and not (self.message[self.ind] == '\\\\'
-                        and self.message[self.ind+1].startswith('arXiv:'))):
-            """
-            new entry starts at ind.
-            """
-            self.ind += 1
-            if self.ind >= self.__len:
-                raise ArXivEnd
-        self.ind += 1
-        logger.info("__next_entry: found (%d)" % self.ind)
-
-    def parse(self):
-        """Parsr the arxiv content."""
+        with self.lock:
+            if target in self.active:
+                return False
+            self.active.add(target)
+        thread = threading.Thread(target=self._run,
+                                  args=(url, target, callback))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def busy(self):
+        with self.lock:
+            return bool(self.active)
+
+    def _run(self, url, target, callback):
+        name = os.path.basename(target)
+        shown = [-1]
+
+        def progress(done, total):
+            if total:
+                percent = 100*done//total
+                if percent != shown[0]:
+                    shown[0] = percent
+                    self.messages.put("getting %s: %d%% of %.1fMB"
+                                      % (name, percent, total/1048576.0))
+            elif done//1048576 != shown[0]:
+                shown[0] = done//1048576
+                self.messages.put("getting %s: %.1fMB"
+                                  % (name, done/1048576.0))
 
-        self.message = [l[:-1] for l in email_iterator(self)]
-        self.__len = len(self.message)
-        ind = 0
         try:
-            while ind <= len(self.message):
-                # print("while loop: (%d)" % self.ind)
-                self.__next_entry()
-                data = {}
-                """
-                Data from one entry.
-
-                XXX: it is using try:except clause. It is better to use break.
-                """
-                try:
-                    while (self.ind < self.__len-1
-                           and not re.match('-+$', self.message[self.ind])):
-                        # print("while loop 2: (%d) %s" % (self.ind,
-                        # self.message[self.ind]))
-                        line = self.message[self.ind]
-                        if line.startswith('arXiv:'):
-                            data['arxiv_nr'] = line[6:15]
-                            logger.info(">> ARXIV: %s" % line[6:15])
-                            self.ind += 1
-                        elif line.startswith("Date: "):
-                            # first remove the locale dependent info from the
-                            # time (english names of the day and the month).
-                            time = line[6:35].split()
-                            time_str = "%s %s %s %s" % (time[1],
-                                                        time[3],
-                                                        time[4],
-                                                        time[5])
-                            data['time'] = datetime.datetime.strptime(
-                                time_str,
-                                "%d %Y %H:%M:%S %Z"
-                            )
-                            logger.info(">> time %s" % data['time'])
-                            self.ind += 1
-                        elif line.startswith("Title: "):
-                            title = line[7:]
-                            self.ind += 1
-                            while self.message[self.ind].startswith(' '):
-                                title += (' '+self.message[self.ind])
-                                self.ind += 1
-                            title = re.sub('\s+', ' ', title)
-                            data['title'] = title
-                            logger.info(">> TITLE: %s" % title)
-                        elif line.startswith("Authors: "):
-                            authors = line[9:]
-                            self.ind += 1
-                            while self.message[self.ind].startswith(' '):
-                                authors += (' '+self.message[self.ind])
-                                self.ind += 1
-                            authors = re.sub('\s+', ' ', authors)
-                            logger.info(">> AUTHORS: %s" % authors)
-                            data['authors'] = authors
-                        elif line.startswith("Categories: "):
-                            data["categories"] = line[12:]
-                            logger.info(">> categories %s"
-                                        % data['categories'])
-                            self.ind += 1
-                        elif line.startswith("MSC-class: "):
-                            data["class"] = line[11:]
-                            logger.info(">> class %s" % data['class'])
-                            self.ind += 1
-                        elif line.startswith("Comments: "):
-                            comments = line[10:]
-                            self.ind += 1
-                            while self.message[self.ind].startswith(' '):
-                                comments += (' '+self.message[self.ind])
-                                self.ind += 1
-                            comments = re.sub('\s+', ' ', comments)
-                            data['comments'] = comments
-                            logger.info(">> comments (%d) %s"
-                                        % (self.ind, data['comments']))
-                            # print("comments: END (%d)" % self.ind)
-                            # print("comments: %s" % comments)
-                        elif line == '\\\\':
-                            logger.info(">> abstract (%d)" % self.ind)
-                            logger.info("__%s__" % self.message[self.ind+1])
-                            self.ind += 1
-                            abstract = ""
-                            """ parse the abstract """
-                            while not self.message[self.ind].startswith(
-                                '\\\\ ( http://arxiv.org'
-                            ):
-                                logger.info(">>          (%d)" % self.ind)
-                                abstract += (" "+self.message[self.ind])
-                                self.ind += 1
-                            data['abstract'] = abstract.strip()
-                        elif line.startswith('\\\\ ( http://arxiv.org'):
-                            comma_ind = line.index(',')
-                            url = line[5:comma_ind-1]
-                            data['url'] = url
-                            logger.info(">> url %s" % data['url'])
-                            self.ind += 1
-                            raise ArXivEntryEnd
-                        else:
-                            logger.info(">>> skipping (%d) %s"
-                                        % (self.ind, self.message[self.ind]))
-                            self.ind += 1
-                except ArXivEntryEnd:
-                    pass
-
-                self.data.append(data)
-                self.__next_entry()
+            with profile.timer("download"):
+                download_pdf(url, target, progress)
+        except (IOError, OSError) as e:
+            logger.warning("download of %s failed: %s", url, e)
+            self.messages.put("Cannot download %s" % url)
+        else:
+            self.messages.put("written to %s" % target)
+            if callback:
+                callback(target)
+        finally:
+            with self.lock:
+                self.active.discard(target)
 
-        except ArXivEnd:
-            pass
 
-        logger.info("TITLES:")
-        for (i, title) in enumerate(map(lambda d: d['title'].encode("utf8"),
-                                        self.data)):
-            logger.info("(%d) %s" % (i, title))
+def highlight_class(data, author_pattern=None, abstract_pattern=None):
+    """
+    Classify an entry: 1 if one of its authors matches author_pattern, 2 if
+    its title or abstract matches abstract_pattern, 0 otherwise.  (These are
+    also the curses color pairs of the titles.)
+    """
+    if author_pattern and author_pattern.search(data.authors or ""):
+        return 1
+    elif abstract_pattern and (abstract_pattern.search(data.title or "")
+                               or abstract_pattern.search(data.abstract
+                                                          or "")):
+        return 2
+    return 0
 
 
-class HTML_GetVersions(SGMLParser):
+def wrap_line(line, width):
     """
-    This is htmlparser which reads the arxiv web page of a given paper and gets
-    all its version in a list self.version_list = [ 'v1', 'v2', 'v3' ].
+    Wrap line so that it fits in the window of width=width.  In a window too
+    narrow for the margin (the terminal can be resized to a few columns)
+    every line has one character.
     """
+    width -= 5
+    lines = textwrap.wrap(line, max(1, width-1), subsequent_indent="  ")
+    return lines
 
-    def reset(self):
-        """ Use this instead of redefining __init__(). It is called every time
-        the parser is reset and makes it possible to reuse the same parser
-        object. It is called also by the __init__() method."""
-        self.h2 = False
-        self.b = False
-        self.in_submission_section = False
-        self.version_list = []
-        # super(type(self),self).reset()
-        SGMLParser.reset(self)
 
-    def start_h2(self, attrs):
-        self.h2 = True
+class TitleLayout(object):
+    """
+    The layout of titles in the titles window: wrapped lines of every entry
+    and the prefix sums of their lengths, i.e. self.starts[ind] is the row at
+    which the ind-th entry starts.
+
+    The titles are wrapped lazily and only once for a given width: self.lines
+    and self.starts cover only the first entries, as many as were asked for
+    (through start(), height(), title_lines(), entry_at() or rows()).  When
+    the width changes (the terminal was resized) update() drops the layout,
+    so only the titles up to the visible ones are wrapped again at once and
+    the rest when they are needed.
+    """
 
-    def end_h2(self):
-        self.h2 = False
+    def __init__(self, data):
+        self.data = data
+        self.width = None
+        self.lines = []
+        self.starts = [0]
 
-    def start_b(self, attrs):
-        self.b = True
+    def update(self, width):
+        """
+        Bring the layout up to date with the window width and self.data.
+        Returns self.
+        """
+        if width != self.width:
+            self.width = width
+            self.lines = []
+            self.starts = [0]
+        return self
 
-    def end_b(self):
-        self.b = False
+    def forget(self, ind):
+        """
+        Drop the layout from the ind-th title on (it was replaced).
+        """
+        del self.lines[ind:]
+        del self.starts[ind+1:]
 
-    def handle_data(self, text):
-        if self.h2:
-            if text == "Submission history":
-                self.in_submission_section = True
-            else:
-                self.in_submission_section = False
-            return
-        if self.in_submission_section:
-            if self.b:
-                if re.match("\[v\d+\]$", text):
-                    self.version_list.append(text[1:-1])
+    def wrap(self, ind):
+        """
+        Wrap the titles up to the ind-th one (all of them if ind is None).
+        """
+        if ind is None:
+            ind = len(self.data)-1
+        for data in self.data[len(self.lines):ind+1]:
+            lines = wrap_line(data.title or "", self.width)
+            self.lines.append(lines)
+            self.starts.append(self.starts[-1]+len(lines))
+
+    def count(self):
+        """
+        The number of entries.
+        """
+        return len(self.data)
 
+    def rows(self):
+        """
+        The number of rows of all titles.
+        """
+        self.wrap(None)
+        return self.starts[-1]
 
-class HTML_GetAbstract(SGMLParser):
+    def start(self, ind):
+        """
+        The row at which the ind-th title starts (the number of rows of the
+        titles before it).
+        """
+        self.wrap(ind-1)
+        return self.starts[ind]
 
-    def reset(self):
-        self._abstract = False
-        self._blockquote = False
-        self.abstract = ""
-        # super(type(self),self).reset()
-        SGMLParser.reset(self)
+    def height(self, ind):
+        """
+        The number of rows of the ind-th title.
+        """
+        self.wrap(ind)
+        return self.starts[ind+1]-self.starts[ind]
 
-    def start_blockquote(self, attrs):
-        self._blockquote = True
+    def title_lines(self, ind):
+        """
+        The wrapped lines of the ind-th title.
+        """
+        self.wrap(ind)
+        return self.lines[ind]
 
-    def end_blockquote(self):
-        self._blockquote = False
-        self._abstract = False
+    def entry_at(self, y):
+        """
+        Index of the entry shown at row y (len(self.data) if y is below the
+        last title).
+        """
+        while self.starts[-1] <= y and len(self.lines) < len(self.data):
+            # every title has at least one row
+            self.wrap(len(self.lines)+y-self.starts[-1])
+        if y >= self.starts[-1]:
+            return len(self.data)
+        return bisect.bisect_right(self.starts, y)-1
 
-    def start_span(self, attr):
-        self._span = True
 
-    def end_span(self):
-        self._span = False
+class TitleView(object):
+    """
+    Draws the visible part of the list of titles in a curses window.
 
-    def handle_data(self, text):
-        if self._blockquote:
-            if self._span and text.startswith("Abstract"):
-                self._abstract = True  # is set False by self.end_blockquote()
-                return
-        if self._abstract:
-            self.abstract = text
-            return
+    Only the rows from self.top to self.top+height are drawn, so the cost of
+    a redraw does not depend on the length of the digest.  Every row on the
+    screen is described by a tuple (number, number_attr, line, title_attr)
+    and render() rewrites only the rows whose description changed since
+    they were drawn.
+    """
 
+    def __init__(self, window, layout, attrs):
+        self.window = window
+        self.layout = layout
+            # TitleLayout
+        self.attrs = attrs
+            # function: ind -> (number_attr, title_attr)
+        self.top = 0
+            # the first row on the screen
+        self.current = 0
+            # index of the entry under the cursor
+        self.drawn = []
+            # descriptions of the rows on the screen
+
+    def titles(self):
+        return self.layout.update(self.window.getmaxyx()[1])
+
+    def height(self):
+        return self.window.getmaxyx()[0]
+
+    def invalidate(self):
+        """
+        Redraw all rows on the next render() (when the window was covered).
+        """
+        self.drawn = []
 
-if __name__ == "__main__":
+    def follow(self):
+        """
+        Scroll so that the current entry is visible.
+        """
+        titles = self.titles()
+        if self.current >= titles.count():
+            return
+        start = titles.start(self.current)
+        end = titles.start(self.current+1)
+        if start < self.top:
+            self.top = start
+        elif end > self.top+self.height():
+            self.top = min(start, end-self.height())
+
+    def render(self):
+        window = self.window
+        titles = self.titles()
+        height = self.height()
+        if len(self.drawn) != height:
+            self.drawn = [None]*height
+        ind = titles.entry_at(self.top)
+        attrs = None
+        for y in range(height):
+            row = self.top+y
+            if ind < titles.count() and row >= titles.start(ind+1):
+                ind += 1
+                attrs = None
+            if ind >= titles.count():
+                description = None
+            else:
+                if attrs is None:
+                    attrs = self.attrs(ind)
+                start = titles.start(ind)
+                first = row == start
+                description = (ind+1 if first else None,
+                               attrs[0] if first else None,
+                               titles.title_lines(ind)[row-start],
+                               attrs[1])
+            if description == self.drawn[y]:
+                continue
+            self.drawn[y] = description
+            window.move(y, 0)
+            window.clrtoeol()
+            if description is None:
+                continue
+            (number, number_attr, line, title_attr) = description
+            try:
+                if number:
+                    window.addstr(y, 0, "(%d)" % number, number_attr)
+                window.addstr(y, 5, line.encode("utf8"), title_attr)
+            except CursesError as e:
+                logger.warning("ERROR: %s: row %d, %s", e, y, description)
+        window.refresh()
 
-    """ Read the email from the standard input (designed for mutt). """
-    message = sys.stdin.read().decode(encoding="utf8", errors='replace')
-    # message = map(lambda line: line.decode("utf8"), message)
-    # Wec need to reopen the terminal for the curses module (window.getch()
-    # method):
-    tty = open("/dev/tty")
-    os.dup2(tty.fileno(), 0)
 
-    # Read configuration from the environment
+def highlight_patterns():
+    """
+    Read (author_pattern, abstract_pattern) for highlight_class() from the
+    environment: ${ARXIV_AUTHORS} and ${ARXIV_ABSTRACT_PATTERN}.
+    """
     if os.getenv("ARXIV_AUTHORS"):
         """
         make the pattern to match for authors.
@@ -389,42 +2381,374 @@ if __name__ == "__main__":
     if os.getenv("ARXIV_ABSTRACT_PATTERN"):
         abstract_pattern = re.compile(os.getenv("ARXIV_ABSTRACT_PATTERN"),
                                       re.MULTILINE or re.IGNORECASE)
-        logger.info(">> abstract_pattern=[%s]" % abstract_pattern.pattern)
+        logger.debug(">> abstract_pattern=[%s]", abstract_pattern.pattern)
     else:
         abstract_pattern = None
+    return (author_pattern, abstract_pattern)
+
+
+def is_arxiv_digest(message):
+    return (message.get('From') or '').startswith('no-reply@arXiv.org ')
+
+
+def message_time(raw_message):
+    """
+    The time (seconds since the epoch) in the Date header of a raw email, 0
+    if it has none.
+    """
+    headers = email_HeaderParser().parsestr(raw_message, headersonly=True)
+    date = email_parsedate_tz(headers.get('Date') or '')
+    return date and email_mktime_tz(date) or 0
+
+
+def iter_messages(path):
+    """
+    Yield the raw emails of a mailbox: a Maildir folder, an mbox file or a
+    file with a single email.
+    """
+    if os.path.isdir(path):
+        box = mailbox.Maildir(path, factory=None, create=False)
+    else:
+        with open(path) as sock:
+            first_line = sock.readline()
+        if not first_line.startswith("From "):
+            with open(path) as sock:
+                yield sock.read()
+            return
+        box = mailbox.mbox(path, factory=None, create=False)
+    for key in box.iterkeys():
+        yield box.get_string(key)
+
+
+batch_patterns = (None, None)
+    # (author_pattern, abstract_pattern) in the batch_main() workers
+
+
+def batch_init(patterns):
+    global batch_patterns
+    batch_patterns = patterns
+
+
+def batch_parse(message):
+    """
+    Parse a raw email in a worker process of batch_main().  Returns the
+    number of entries and their JSON lines, (None, "") if it is not an
+    arXiv digest, or (None, None) if it cannot be parsed (the error is
+    logged): one malformed digest does not stop the others.
+    """
+    try:
+        arxiv = email_Parser(ArXivParser).parsestr(
+            message.decode(encoding="utf8", errors='replace'))
+        if not is_arxiv_digest(arxiv):
+            return (None, "")
+        lines = []
+        for data in arxiv.iter_entries():
+            entry = dict(data)
+            if entry.get('time'):
+                entry['time'] = entry['time'].isoformat()
+            entry['highlight'] = highlight_class(data, *batch_patterns)
+            entry['digest'] = arxiv.get('Message-ID')
+            lines.append(json.dumps(entry, sort_keys=True)+"\n")
+    except Exception:
+        message_id = email_HeaderParser().parsestr(message).get('Message-ID')
+        logger.exception("cannot parse the digest %s", message_id)
+        return (None, None)
+    return (len(lines), "".join(lines))
+
+
+def batch_main(argv):
+    """
+    arxiv_reader.py batch: parse all arXiv digests in the given mailboxes in
+    a pool of processes and write their entries as JSON lines.
+    """
+    parser = argparse.ArgumentParser(
+        prog="arxiv_reader.py batch",
+        description="Parse arXiv digests from mbox files or Maildir folders "
+                    "and write their entries (with the highlight class) as "
+                    "JSON lines.")
+    parser.add_argument("mailboxes", nargs="+", metavar="MAILBOX")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("-o", "--output", default="-",
+                        help="output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    if args.output == "-":
+        output = sys.stdout
+    else:
+        output = open(args.output, "w")
+    start = time.time()
+    (digests, skipped, failed, entries) = (0, 0, 0, 0)
+    pool = multiprocessing.Pool(args.jobs, batch_init,
+                                (highlight_patterns(),))
+    try:
+        messages = itertools.chain.from_iterable(
+            iter_messages(path) for path in args.mailboxes)
+        for (n, lines) in pool.imap(batch_parse, messages, chunksize=8):
+            if lines is None:
+                failed += 1
+                continue
+            if n is None:
+                skipped += 1
+                continue
+            digests += 1
+            entries += n
+            output.write(lines)
+    except BaseException:
+        # an interrupt, or an error of the output (e.g. a closed pipe):
+        # join() may only follow close() or terminate()
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        if output is not sys.stdout:
+            output.close()
+    elapsed = max(time.time()-start, 1e-6)
+    sys.stderr.write("%d digests (%d other emails skipped, %d failed), "
+                     "%d entries in %.2fs: %.1f digests/s, %.0f entries/s\n"
+                     % (digests, skipped, failed, entries, elapsed,
+                        digests/elapsed, entries/elapsed))
+    if failed:
+        sys.stderr.write("the errors are in %s\n" % log_file)
+    return os.EX_OK
+
+
+def bibtex_braces(value):
+    """
+    value without its unbalanced braces: BibTeX counts the braces of a
+    {...} field (even after a backslash), one too many ends the field early
+    and one missing swallows the rest of the file.  Balanced braces
+    ({\\em ...}, {SU(2)}) are kept.
+    """
+    chars = list(value)
+    opened = []
+        # indexes of the braces not closed yet
+    for (i, char) in enumerate(chars):
+        if char == '{':
+            opened.append(i)
+        elif char == '}':
+            if opened:
+                opened.pop()
+            else:
+                chars[i] = ''
+    for i in opened:
+        chars[i] = ''
+    return ''.join(chars)
+
+
+def bibtex_entry(paper):
+    """
+    A BibTeX @misc entry of paper (a dictionary as in ArXivDB.select()).
+    """
+    arxiv_nr = paper['arxiv_nr'] or ""
+    authors = " and ".join(split_authors(paper['authors']))
+    categories = (paper['categories'] or "").split()
+    year = (paper['time'] or "")[:4]
+    if not year and re.match(r"\d{4}\.", arxiv_nr):
+        year = "20" + arxiv_nr[:2]
+    fields = [('title', paper['title']),
+              ('author', authors),
+              ('year', year),
+              ('eprint', arxiv_nr),
+              ('archivePrefix', "arXiv"),
+              ('primaryClass', categories and categories[0]),
+              ('url', paper['url']),
+              ('note', paper['comments']),
+              ('abstract', paper['abstract'])]
+    lines = ["@misc{%s," % (arxiv_nr or "arxiv")]
+    lines.extend("  %s = {%s}," % (name, bibtex_braces(value))
+                 for (name, value) in fields if value)
+    lines.append("}\n")
+    return "\n".join(lines)
+
+
+def export_main(argv):
+    """
+    arxiv_reader.py export: write the papers saved in ${ARXIV_DB} as JSON
+    lines, BibTeX or CSV.
+    """
+    parser = argparse.ArgumentParser(
+        prog="arxiv_reader.py export",
+        description="Write the papers saved in the database as JSON lines, "
+                    "BibTeX or CSV, in the order in which they were saved.")
+    parser.add_argument("-f", "--format", default="jsonl",
+                        choices=("jsonl", "bibtex", "csv"))
+    parser.add_argument("-o", "--output", default="-",
+                        help="output file (default: stdout)")
+    parser.add_argument("--db", default=arxiv_db,
+                        help="the database (default: %(default)s)")
+    parser.add_argument("--since", metavar="YYYY-MM-DD",
+                        help="saved on this day or later")
+    parser.add_argument("--until", metavar="YYYY-MM-DD",
+                        help="saved on this day or earlier")
+    parser.add_argument("--status")
+    parser.add_argument("--category", help="e.g. math.AG")
+    parser.add_argument("--author", help="a part of an author's name")
+    args = parser.parse_args(argv)
+
+    db = ArXivDB(args.db)
+    if db.connect() is None:
+        sys.stderr.write("%s does not exist\n" % args.db)
+        return os.EX_DATAERR
+    if args.output == "-":
+        output = sys.stdout
+    else:
+        output = open(args.output, "w")
+    papers = db.select(since=args.since, until=args.until,
+                       status=args.status, category=args.category,
+                       author=args.author)
+    try:
+        if args.format == "csv":
+            writer = csv.writer(output)
+            writer.writerow(ArXivDB.FIELDS)
+            for paper in papers:
+                writer.writerow([unicode(paper[f] or "").encode("utf8")
+                                 for f in ArXivDB.FIELDS])
+        else:
+            for paper in papers:
+                if args.format == "jsonl":
+                    line = json.dumps(paper, sort_keys=True)+"\n"
+                else:
+                    line = bibtex_entry(paper)+"\n"
+                output.write(line.encode("utf8"))
+    finally:
+        db.close()
+        if output is not sys.stdout:
+            output.close()
+    return os.EX_OK
+
+
+COMMANDS = {
+    'batch': batch_main,
+    'export': export_main,
+}
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
+    if len(sys.argv) > 1:
+        # digests from mailboxes: all of them in one session
+        raw_messages = sorted(itertools.chain.from_iterable(
+            iter_messages(path) for path in sys.argv[1:]),
+            key=message_time)
+    else:
+        """ Read the email from the standard input (designed for mutt). """
+        raw_messages = [sys.stdin.read()]
+    # Wec need to reopen the terminal for the curses module (window.getch()
+    # method):
+    tty = open("/dev/tty")
+    os.dup2(tty.fileno(), 0)
 
-    parser = email_Parser(ArXivParser)
-    arxiv = parser.parsestr(message)
-    arxiv.parse()
-    if not arxiv.get('From').startswith('no-reply@arXiv.org '):
+    # Read configuration from the environment
+    (author_pattern, abstract_pattern) = highlight_patterns()
+
+    digests = []
+        # [key, entries, abstracts] of every digest: the digest cache key,
+        # the list of its entries and the number of abstracts which the
+        # digest cache has (None if it does not have the digest)
+    sources = []
+        # iterators of the entries of every digest
+    for raw_message in raw_messages:
+        digest_key = DigestCache.key(raw_message)
+        cached = digest_cache.load(digest_key)
+        if cached is not None:
+            # this email was opened before: use its entries without parsing
+            # it
+            digests.append([digest_key, cached,
+                            sum(1 for d in cached if d.abstract)])
+            sources.append(iter(cached))
+            continue
+        message = email_Parser(ArXivParser).parsestr(
+            raw_message.decode(encoding="utf8", errors='replace'))
+        if not is_arxiv_digest(message):
+            continue
+        digests.append([digest_key, message.data, None])
+        sources.append(message.iter_entries())
+    del raw_messages
+    if not digests:
         sys.stdout.write("Not a newsletter from arXiv.\n")
         sys.exit(os.EX_DATAERR)
 
-    logger.info("___CURSES___")
+    session = DigestMerge()
+    arxiv = ArXivParser()
+    arxiv.data = session.data
+        # the merged entries of all digests
+    seen_papers = SeenPapers(ARXIV_SEEN_DB)
 
-    def wrap_line(line, width):
+    def merge_entries():
         """
-        Wrap line so that it fits in the window of width=width.
+        Parse the digests and merge their entries into arxiv.data (without
+        the papers seen before if ${ARXIV_SEEN} is 'hide': they are looked
+        up 100 entries at a time).
         """
-        width -= 5
-        lines = textwrap.wrap(line, width-1, subsequent_indent="  ")
-        return lines
+        parsed = itertools.chain.from_iterable(sources)
+        while True:
+            chunk = list(itertools.islice(parsed, 100))
+            if not chunk:
+                return
+            hidden = set()
+            if ARXIV_SEEN == 'hide':
+                hidden = seen_papers.seen([d.arxiv_nr for d in chunk])
+            for data in chunk:
+                if data.arxiv_nr in hidden:
+                    continue
+                ind = session.merge(data)
+                if ind is not None:
+                    # a replaced entry
+                    layout.forget(ind)
+                yield data
+
+    entries = merge_entries()
+        # the digests are parsed lazily: first only the entries which fill
+        # the first screen, the rest after it is drawn (see CursesWindow()).
+
+    def cache_digest():
+        """
+        Store the entries of every digest in the digest cache if it does not
+        have all the abstracts we know.
+        """
+        for digest in digests:
+            (digest_key, data, cached_abstracts) = digest
+            abstracts = sum(1 for d in data if d.abstract)
+            if abstracts == cached_abstracts:
+                continue
+            try:
+                digest_cache.store(digest_key, data)
+            except (IOError, OSError) as e:
+                logger.warning("cannot store the digest: %s", e)
+            digest[2] = abstracts
+
+    logger.debug("___CURSES___")
 
     """ Initialise curses """
-    # XXX: make it work after changing the terminal window.
-    # (y_stdscr, x_stdscr) are updated in the main loop, but this is not
-    # enough.
     stdscr = curses.initscr()
     (y_stdscr, x_stdscr) = stdscr.getmaxyx()
-    ypad = max(sum(map(lambda d: len(wrap_line(d['title'],
-                                               stdscr.getmaxyx()[1])),
-                       arxiv.data))+1,
-               y_stdscr)
-        # the lenght of pad (since stdscr and stdpad will have the same width
-        # we can use stdscr to comute its lenght)
-        # XXX: without +1: last line is repeated till the end of stdscr. Why?
-    stdpad = curses.newpad(ypad, x_stdscr)
-    (ytop, xtop) = (0, 0)  # stdpad
+        # updated by key_resize() when the terminal is resized.
+    layout = TitleLayout(arxiv.data)
+        # use title_layout() to get it up to date.
+    with profile.timer("parse: first screen"):
+        for data in entries:
+            if layout.update(x_stdscr).rows() >= y_stdscr:
+                break
+    if not arxiv.data:
+        # the whole digest was parsed: there is nothing to show
+        curses.endwin()
+        seen_papers.close()
+        cache_digest()
+        if ARXIV_SEEN == 'hide':
+            sys.stdout.write("All the papers of the newsletter were seen.\n")
+            sys.exit(os.EX_OK)
+        sys.stdout.write("No paper in the newsletter.\n")
+        sys.exit(os.EX_DATAERR)
+    titles_window = curses.newwin(y_stdscr-1, x_stdscr, 0, 0)
+        # the titles (all lines but the status line), see TitleView.
+    titles_window.keypad(1)
     curses.start_color()
     curses.use_default_colors()
     # use this for transparency (then -1 can be used as the default background
@@ -452,12 +2776,12 @@ if __name__ == "__main__":
         """
         Clear the status line.
         """
-        global stdscr, stdpad
+        global stdscr
         (ymax, xmax) = stdscr.getmaxyx()
         stdscr.move(ymax-1, 0)
         stdscr.clrtoeol()
         stdscr.refresh()
-        stdpad.refresh(ytop, 0, 0, 0, y_stdscr-2, x_stdscr)
+        titles_window.refresh()
 
     def print_status(msg):
         """
@@ -467,280 +2791,213 @@ if __name__ == "__main__":
         global stdscr
         (y, x) = stdscr.getyx()
         (ymax, xmax) = stdscr.getmaxyx()
-        # Truncate the msg if it doesn't fit the status line:
-        stdscr.addstr(ymax-1, 0, msg[:xmax])
+        # Truncate the msg if it doesn't fit the status line (curses cannot
+        # write to the last cell of the screen):
+        stdscr.addstr(ymax-1, 0, msg[:xmax-1])
         stdscr.refresh()
         stdscr.move(y, x)
 
+    def title_layout(window):
+        """
+        Return the TitleLayout for the width of the window.
+        """
+        return layout.update(window.getmaxyx()[1])
+
     def get_index(window):
         """
-        Compute the index of the title under the cursor (y) in the list
-        arxive.data list.
+        The index of the title under the cursor in the list arxive.data.
+        Returns (i, ind) where i is the row just below the title.
         """
-        (y, x) = window.getyx()
-        ind = 0
-        i = 0
-        for data in arxiv.data:
-            i += len(wrap_line(data['title'], window.getmaxyx()[1]))
-            if i > y:
-                break
-            ind += 1
-        logger.info("<< i=%d y=%d" % (i, y))
+        titles = title_layout(window)
+        ind = view.current
+        i = titles.start(min(ind+1, titles.count()))
         return (i, ind)
 
     def version_list(data):
-        print_status("reading %s" % data["url"])
-        parser = HTML_GetVersions()
+        if data.arxiv_nr not in papers.records:
+            print_status("reading %s" % data.url)
         try:
-            sock = urllib.urlopen(data["url"])
+            return papers.get(data.arxiv_nr, data.url).versions
         except IOError as e:
-            print_status("Cannot connect with %s" % data['url'])
+            print_status("Cannot connect with %s" % data.url)
             return []
-        else:
-            htmlSource = sock.read()
-            sock.close()
-            parser.feed(htmlSource)
-            parser.close()
-            return parser.version_list
-
-    attr_dict = {}
-
-    # dictionary { i : color } where color is 1 (RED) or 2 (GREEN) (see
-    # cursor.init_pair() above) and i is the index in arxive.data list.
-    def print_titles(window, init=False):
-        """
-        Print titles in the window.
-        """
-        logger.info("PRINT LINES")
-        width = min([78, window.getmaxyx()[1]-5])
-        ind = 0
-        nr = 1
-        for (i, data) in enumerate(arxiv.data):
-            title_lines = wrap_line(data['title'], window.getmaxyx()[1])
-            first = True
-            for line in title_lines:
-                if author_pattern and re.search(author_pattern,
-                                                data['authors']):
-                    highlight = 1
-                elif abstract_pattern and (re.search(abstract_pattern,
-                                                     data['title'])
-                                           or re.search(abstract_pattern,
-                                                        data.get('abstract',
-                                                                 ""))):
-                    highlight = 2
-                else:
-                    highlight = 0
-                logger.info("title [%s]\n      with color %d"
-                            % (data['title'], highlight))
-                logger.info("      title match %s"
-                            % (not re.search(abstract_pattern,
-                                             data['title']) is None))
-                if first:
-                    try:
-                        if os.path.exists(arxiv_db):
-                            with sqlite3.connect(arxiv_db) as conn:
-                                arxiv_nr = data['arxiv_nr']
-                                row = conn.execute(
-                                    "SELECT arxiv_nr FROM "
-                                    "arxiv WHERE arxiv_nr = ?", (arxiv_nr,)
-                                )
-                                color = len(list(row.fetchall())) and 1 or 2
-                        else:
-                            color = 2
-                        attr_dict[i] = color
-                        window.addstr(ind,
-                                      0,
-                                      "(%d)" % nr,
-                                      curses.color_pair(color))
-                        # XXX: Check if the entry is in the db. If it is use
-                        # curses.color_pair(1) (RED)
-                    except CursesError as e:
-                        logger.info("ERROR: %s at line %d: (%d)"
-                                    % (e.message,
-                                       sys.exc_info()[2].tb_lineno,
-                                       nr))
-                        logger.info("       ind=%d, yx=(%d,%d)"
-                                    % (ind,
-                                       window.getyx()[0],
-                                       window.getyx()[0]))
-                        pass
-                    nr += 1
-                try:
-                    window.addstr(ind, 5, line.encode("utf8"),
-                                  curses.color_pair(highlight))
-                except CursesError:
-                    logger.info("ERROR: %s at line %d: (%d) %s"
-                                % (e.message,
-                                   sys.exc_info()[2].tb_lineno,
-                                   nr,
-                                   line.encode("utf8")))
-                    logger.info("       ind=%d, yx=(%d,%d)"
-                                % (ind,
-                                   window.getyx()[0],
-                                   window.getyx()[0]))
-                    pass
-                ind += 1
-                first = False
-        (y, x) = window.getyx()
-        if init:
-            color = (attr_dict[0] == 1 and 4 or 5)
-            window.chgat(0, 0, 3, curses.color_pair(color))
-        window.refresh(ytop, 0, 0, 0, y_stdscr-2, x_stdscr)
+
+    db = ArXivDB(arxiv_db)
+    prefetcher = AbstractPrefetcher(fetch_abstracts, ARXIV_PREFETCH,
+                                    ARXIV_API_BATCH)
+    downloads = PDFDownloads()
+    saved = set()
+        # arxiv_nr's of entries which are in the database: filled in
+        # CursesWindow() and kept up to date by key_save_to_db() and
+        # key_delete_from_db().
+    seen = set()
+        # arxiv_nr's of entries whose details were viewed (now or before, see
+        # SeenPapers): their titles are dimmed.  Filled in CursesWindow() and
+        # by key_enter().
+    relevance = [None]
+        # the RelevanceModel (loaded by rank_entries())
+    relevant = set()
+        # arxiv_nr's of the entries with the best tenth of the scores: their
+        # titles are bold
+    marked = set()
+        # indexes (in arxiv.data) of marked entries: key_save_to_db() and
+        # key_delete_from_db() act on all of them at once.
+    mark_anchor = [0]
+        # the last entry toggled with key_mark(), where key_mark_range()
+        # starts.
+
+    def highlight(ind):
+        """
+        The highlight_class() of the ind-th entry.  It is computed once and
+        then again only if the abstract of the entry changes.
+        """
+        data = arxiv.data[ind]
+        if data.highlight_cache is not None:
+            (abstract, color) = data.highlight_cache
+            if abstract is data.abstract:
+                return color
+        color = highlight_class(data, author_pattern, abstract_pattern)
+        data.highlight_cache = (data.abstract, color)
+        return color
+
+    def entry_attrs(ind):
+        """
+        Curses attributes of the ind-th entry: (number_attr, title_attr).
+        The number is red (1) if the entry is in the database and green (2)
+        otherwise, and on blue (4) or green (5) background under the cursor.
+        The title has the highlight() color, it is dimmed when the entry was
+        seen, bold when it is relevant (see rank_entries()) and reversed
+        when marked.
+        """
+        arxiv_nr = arxiv.data[ind].arxiv_nr
+        color = arxiv_nr in saved and 1 or 2
+        if ind == view.current:
+            color = (color == 1 and 4 or 5)
+        title_attr = curses.color_pair(highlight(ind))
+        if arxiv_nr in seen:
+            title_attr |= curses.A_DIM
+        if arxiv_nr in relevant:
+            title_attr |= curses.A_BOLD
+        if ind in marked:
+            title_attr |= curses.A_REVERSE
+        return (curses.color_pair(color), title_attr)
+
+    view = TitleView(titles_window, layout, entry_attrs)
+
+    def print_titles(window):
+        """
+        Print the visible titles in the window (only the rows which changed
+        are redrawn).
+        """
+        with profile.timer("render"):
+            view.render()
 
     def key_up(window):
         # The key_{NAME}() functions: actions on key presses.
-        (y, x) = window.getyx()
-        x = 0
-        ind = get_index(window)[1]
-        window.chgat(y, x, len("(%s)"
-                               % str(ind+1)),
-                     curses.color_pair(attr_dict[ind]))
-        if y:
-            jump = len(wrap_line(arxiv.data[ind-1]['title'],
-                                 window.getmaxyx()[1]))
-            py = y-jump
-        else:
-            jump = len(wrap_line(arxiv.data[-1]['title'],
-                                 window.getmaxyx()[1]))
-            py = (sum(map(lambda d: len(wrap_line(d['title'],
-                                                  window.getmaxyx()[1])),
-                          arxiv.data))-jump)
-        logger.info("<< py=%d" % py)
-        window.move(py, x)
-        ind = get_index(window)[1]
-        color = (attr_dict[get_index(window)[1]] == 1 and 4 or 5)
-        window.chgat(py, 0, len("(%s)"
-                                % str(ind+1)), curses.color_pair(color))
+        view.current = (view.current-1) % len(arxiv.data)
+        view.follow()
+        print_titles(window)
         clear_status()
 
     def key_down(window):
-        (y, x) = window.getyx()
-        x = 0
-        ind = get_index(window)[1]
-        ymax = sum(map(lambda d: len(wrap_line(d['title'],
-                                               window.getmaxyx()[1])),
-                       arxiv.data))
-        window.chgat(y, 0, len("(%s)"
-                               % str(ind+1)),
-                     curses.color_pair(attr_dict[ind]))
-        if y < ymax-len(wrap_line(arxiv.data[-1]['title'],
-                                  window.getmaxyx()[1])):
-            jump = len(wrap_line(arxiv.data[ind]['title'],
-                                 window.getmaxyx()[1]))
-            ny = y+jump
-            ind += 1
-        else:
-            ny = 0
-            ind = 0
-        window.move(ny, x)
-        color = (attr_dict[get_index(window)[1]] == 1 and 4 or 5)
-        window.chgat(ny, x, len("(%s)"
-                                % str(ind+1)),
-                     curses.color_pair(color))
+        view.current = (view.current+1) % len(arxiv.data)
+        view.follow()
+        print_titles(window)
         clear_status()
 
-    def key_move_down(stdpad):
-        global ytop
-        if ytop == (sum(map(lambda d: len(wrap_line(d['title'],
-                                                    stdpad.getmaxyx()[1])),
-                            arxiv.data))-1):
-            # do not move below the last line (so at least the last line is
-            # visible)
+    def key_move_down(window):
+        titles = title_layout(window)
+        ind = titles.entry_at(view.top)
+        if ind >= titles.count()-1:
+            # do not move below the last title (so at least it is visible)
             return
-        if stdpad.getyx()[0] == ytop:
+        view.top = titles.start(ind+1)
+        if view.current <= ind:
             # if cursor is at the top move it down
-            key_down(stdpad)
-        ind = get_index(stdpad)[1]-1
-        ytop += len(wrap_line(arxiv.data[ind]['title'], stdpad.getmaxyx()[1]))
-        stdpad.refresh(ytop, 0, 0, 0, y_stdscr-2, x_stdscr)
-
-    def key_move_up(stdpad):
-        global ytop
-        if stdpad.getyx()[0] >= y_stdscr-1:
-            key_up(stdpad)
-        if ytop >= 1:
-            ind = get_index(stdpad)[1]
-            ytop -= len(wrap_line(arxiv.data[ind]['title'],
-                                  stdpad.getmaxyx()[1]))
-            stdpad.refresh(ytop, 0, 0, 0, y_stdscr-2, x_stdscr)
+            view.current = ind+1
+        print_titles(window)
+
+    def key_move_up(window):
+        titles = title_layout(window)
+        if view.top < 1:
+            return
+        view.top = titles.start(titles.entry_at(view.top-1))
+        last = titles.entry_at(view.top+view.height())-1
+            # the last title which is entirely visible
+        if view.current > last:
+            # if cursor is at the bottom move it up
+            view.current = max(last, titles.entry_at(view.top))
+        print_titles(window)
 
     def key_enter(window):
         curses.curs_set(0)
-        (y, x) = window.getyx()
-        width = min([78, window.getmaxyx()[1]-7])
+        width = max(1, min([78, window.getmaxyx()[1]-7]))
         try:
             (i, ind) = get_index(window)
-            authors = wrap_line("Authors: %s"
-                                % arxiv.data[ind].get('authors', ''),
+            data = arxiv.data[ind]
+            authors = wrap_line("Authors: %s" % (data.authors or ''),
                                 window.getmaxyx()[1])
-            title_len = len(wrap_line(arxiv.data[ind].get('title', []),
-                                      window.getmaxyx()[1]))
-            if not arxiv.data[ind].get('abstract', ''):
-                # Read the abstract from the net.
-                print_status("Getting abstract from %s"
-                             % arxiv.data[ind]['url'])
-                parser = HTML_GetAbstract()
-                try:
-                    sock = urllib.urlopen(arxiv.data[ind]["url"])
-                except IOError as e:
-                    print_status("Cannot connect with %s"
-                                 % arxiv.data[ind]['url'])
+            title_len = title_layout(window).height(ind)
+            if not data.abstract:
+                apply_abstracts(window)
+            if not data.abstract:
+                # Read the abstract from the net.  If a prefetcher is
+                # reading its page right now, papers.get() waits for that
+                # page; a batch of the arxiv API is not waited for.
+                prefetcher.cancel(ind)
+                print_status("Getting abstract from %s" % data.url)
+                abstract = fetch_abstract(data)
+                if abstract is None:
+                    print_status("Cannot connect with %s" % data.url)
                 else:
-                    htmlSource = sock.read()
-                    parser.feed(htmlSource)
-                    parser.close()
-                    arxiv.data[ind]['abstract'] = parser.abstract
-                    sock.close()
-            abstract = textwrap.wrap(arxiv.data[ind].get('abstract', ''),
+                    data.abstract = abstract
+            abstract = textwrap.wrap(data.abstract or '', width)
+            comments = textwrap.wrap("Comments: %s" % (data.comments or ''),
                                      width)
-            comments = textwrap.wrap("Comments: %s"
-                                     % arxiv.data[ind].get('comments', ''),
-                                     width)
-            url = arxiv.data[ind].get('url', '')
+            url = data.url or ''
         except IndexError:
             return
+        if ARXIV_SEEN != 'off' and data.arxiv_nr not in seen:
+            seen.add(data.arxiv_nr)
+            seen_papers.add(data.arxiv_nr)
+        d_len = 2+len(authors)+1+len(abstract)+1+len(comments)+2
+        height = view.height()
+        if i-view.top+d_len > height:
+            # scroll so that the title is at the top
+            view.top = i-title_len
+            print_titles(window)
+        # the row of the title on the screen
+        y = i-title_len-view.top
+        d_len = min(d_len, height-y-title_len)
+        if y < 0 or d_len < 3 or window.getmaxyx()[1] < width+6:
+            # not even one line with its border fits below the title
+            print_status("The window is too small to show the details.")
+            return
         for ypos in range(y, y+title_len):
             window.chgat(ypos, 5, -1, curses.color_pair(1))
-        d_len = 2+len(authors)+1+len(abstract)+1+len(comments)+2
-        window.move(y+(i-y), 0)
+        window.move(y+title_len, 0)
         window.clrtobot()
-        window.move(y, x)
-        window.refresh(ytop, 0, 0, 0, y_stdscr-2, x_stdscr)
-        logger.info("<< detail_window d_len=%d, width=%d, "
-                    "y=%d, i=%d, size=%d, ymax=%d"
-                    % (d_len, width, y, i, size, window.getmaxyx()[0]))
+        window.refresh()
+        logger.debug("<< detail_window d_len=%d, width=%d, "
+                     "y=%d, i=%d, ymax=%d", d_len, width, y, i, height)
         try:
-            detail_window = window.subwin(d_len, width+4, y+(i-y), 2)
-            # a subpad shoul be created if the length is to big.
+            detail_window = curses.newwin(d_len, width+4, y+title_len, 2)
         except CursesError as e:
-            logger.info("ERROR: %s at line %d"
-                        % (e.message, sys.exc_info()[2].tb_lineno))
-            logger.info("       this might happen when stdpad is to short"
-                        " for the new subwin")
-            logger.info("       window maxyx (%d,%d), type %s"
-                        % (window.getmaxyx()[0],
-                           window.getmaxyx()[1],
-                           type(window)))
+            logger.error("ERROR: %s at line %d",
+                         e.message, sys.exc_info()[2].tb_lineno)
+            logger.error("       window maxyx (%d,%d)",
+                         window.getmaxyx()[0], window.getmaxyx()[1])
             raise StandardError("_curses.error: %s\n see the log file for more"
                                 " info and the comments in the source file."
                                 % e.message)
 
-        # XXX: there is an error here:
-        # _curses.error: curses function returned NULL
-        for key in arxiv.data[ind]:
-            ypos = 1
-            for line in authors:
-                detail_window.addstr(ypos, 2, line.encode("utf8"))
-                ypos += 1
-            ypos += 1
-            for (ypos_a, line) in enumerate(abstract, ypos):
-                detail_window.addstr(ypos_a, 2, line.encode("utf8"))
-            ypos += len(abstract)+2
-            for (ypos_c, line) in enumerate(comments, ypos):
-                detail_window.addstr(ypos_c, 2, line.encode("utf8"))
+        # the lines which do not fit in the window are left out.
+        lines = (authors + [""] + abstract + [""] + comments)[:max(0, d_len-2)]
+        for (ypos, line) in enumerate(lines, 1):
+            detail_window.addstr(ypos, 2, line.encode("utf8"))
 
         detail_window.border()
-        window.refresh(ytop, 0, 0, 0, y_stdscr-2, x_stdscr)
+        detail_window.refresh()
         keyboard_map = {
             curses.KEY_ENTER: "close",
             10: "close",
@@ -750,25 +3007,28 @@ if __name__ == "__main__":
             ord('u'): key_open_url,
             ord('s'): key_save_to_db,
             ord('d'): key_delete_from_db,
+            curses.KEY_RESIZE: "resize",
         }
         while True:
             # The detailed window loop.
             key = detail_window.getch()
             action = keyboard_map.get(key, None)
-            if action == "close":
+            if action in ("close", "resize"):
                 detail_window.erase()
-                window.erase()
-                print_titles(window, init=False)
-                window.move(y, x)
-                color = (attr_dict[get_index(window)[1]] == 1 and 4 or 5)
-                window.chgat(y, x, len("(%s)"
-                                       % str(ind+1)), curses.color_pair(color))
-                window.refresh(ytop, 0, 0, 0, y_stdscr-2, x_stdscr)
+                detail_window.refresh()
+                del detail_window
+                if action == "resize":
+                    key_resize(window)
+                    break
+                view.invalidate()
+                print_titles(window)
                 break
             elif action == key_open_url:
                 action(window, url)
             elif action:
                 action(window)
+            detail_window.touchwin()
+            detail_window.refresh()
 
     def key_open_url(window, url):
         if url:
@@ -779,132 +3039,285 @@ if __name__ == "__main__":
         else:
             print_status('No url found.')
 
+    def selected_entries(window):
+        """
+        Indexes of the marked entries, or of the entry under the cursor if
+        none is marked.
+        """
+        if marked:
+            return sorted(marked)
+        ind = get_index(window)[1]
+        if ind < len(arxiv.data):
+            return [ind]
+        return []
+
+    def unmark_all(window):
+        marked.clear()
+        print_titles(window)
+
+    def key_mark(window):
+        """
+        Toggle the mark of the entry under the cursor.
+        """
+        ind = get_index(window)[1]
+        if ind >= len(arxiv.data):
+            return
+        if ind in marked:
+            marked.discard(ind)
+        else:
+            marked.add(ind)
+        mark_anchor[0] = ind
+        print_titles(window)
+        print_status("%d marked" % len(marked))
+
+    def key_mark_range(window):
+        """
+        Mark all entries between the last toggled one and the entry under the
+        cursor.
+        """
+        ind = get_index(window)[1]
+        if ind >= len(arxiv.data):
+            return
+        start = min(mark_anchor[0], ind)
+        end = max(mark_anchor[0], ind)
+        for i in range(start, end+1):
+            marked.add(i)
+        print_titles(window)
+        print_status("%d marked" % len(marked))
+
+    def key_mark_highlighted(window):
+        """
+        Mark all highlighted entries (see highlight()).
+        """
+        for i in range(len(arxiv.data)):
+            if highlight(i):
+                marked.add(i)
+        print_titles(window)
+        print_status("%d marked" % len(marked))
+
+    def key_unmark(window):
+        """
+        Clear all marks.
+        """
+        unmark_all(window)
+        clear_status()
+
     def key_save_to_db(window):
         """
-        Save the entry in the sqlite3 database ${ARXIV_DB}.
+        Save the marked entries (or the entry under the cursor) in the sqlite3
+        database ${ARXIV_DB}.
         """
-        global stdpad
-        # must be called before sqlite3.connection()
-        db_exists = os.path.exists(arxiv_db)
-        with sqlite3.connect(arxiv_db) as conn:
-            if not db_exists:
-                conn.executescript(DB_SCHEMA)
-            (i, ind) = get_index(window)
-            fields = ['title', 'authors', 'abstract', 'url', 'comments',
-                      'categories', 'class', 'arxiv_nr', 'time', 'time',
-                      'date', 'status']
-            try:
+        inds = selected_entries(window)
+        if not inds:
+            print_status("No entry to save.")
+            return
+        today = datetime.date.today()
+        for ind in inds:
+            arxiv.data[ind].date = today
+        (written, present) = db.save([arxiv.data[ind] for ind in inds])
+        saved.update(written)
+        saved.update(present)
+        model = relevance[0]
+        if model is not None:
+            for ind in inds:
                 data = arxiv.data[ind]
-            except IndexError:
-                # XXX: wirte to the status line
-                return
-            data['date'] = datetime.date.today()
-            field_list = tuple([data.get(f, "") for f in fields])
-            try:
-                # conn.execute("""
-                        # insert into arxiv
-                             # (title, authors, abstract, url,
-                              # comments, categories, class, arxiv_nr,
-                              # time, status)
-                        # values (?,?,?,?,?,?,?,?,?,?)
-                        # """, field_list)
-                conn.execute("""
-                        INSERT INTO arxiv
-                             (title, authors, abstract, url,
-                              comments, categories, class, arxiv_nr,
-                              time, date, status)
-                        values
-                             (:title, :authors, :abstract, :url,
-                              :comments, :categories, :class, :arxiv_nr,
-                              :time, :date, :status)
-                        """, dict(zip(fields, field_list)))
-                conn.commit()
-                print_status("%s written to db"
-                             % data.get('arxiv_nr', '').encode("utf8"))
-                # change color attr
-                attr_dict[get_index(window)[1]] = 1
-                if window == stdpad:
-                    stdpad.chgat(stdpad.getyx()[0], 0,
-                                 len("(%s)" % str(ind+1)),
-                                 curses.color_pair(4)
-                                 )
-                    stdpad.refresh(ytop, 0, 0, 0,
-                                   y_stdscr-2,
-                                   x_stdscr)
-            except sqlite3.IntegrityError:
-                print_status("%s already in db"
-                             % data.get('arxiv_nr', '').encode("utf8"))
+                if data.arxiv_nr in written:
+                    model.add(data.arxiv_nr, data.title, data.abstract)
+        if len(inds) == 1:
+            arxiv_nr = (arxiv.data[inds[0]].arxiv_nr or '').encode("utf8")
+            if written:
+                print_status("%s written to db" % arxiv_nr)
+            else:
+                print_status("%s already in db" % arxiv_nr)
+        else:
+            print_status("%d entries written to db (%d already in db)"
+                         % (len(written), len(present)))
+        marked.clear()
+        print_titles(window)
 
     def key_delete_from_db(window):
         """
-        Remove the entry from .arxiv.db (if it is present).
+        Remove the marked entries (or the entry under the cursor) from
+        .arxiv.db (if they are present).
         """
-        if not os.path.exists(arxiv_db):
+        if db.connect() is None:
             print_status("db does not exist.")
             return
-        with sqlite3.connect(arxiv_db) as conn:
-            cursor = conn.cursor()
-            try:
-                arxiv_nr = arxiv.data[get_index(window)[1]]['arxiv_nr']
-            except KeyError:
-                pass
-            else:
-                logger.info("SQL: delete arxiv_nr = %s"
-                            % arxiv_nr.encode("utf8"))
-                cursor.execute("DELETE FROM arxiv WHERE arxiv_nr = (?)",
-                               (arxiv_nr.encode("utf8"),))
-                attr_dict[get_index(window)[1]] = 2
-                print_status("%s removed from db" % arxiv_nr.encode("utf8"))
-                if window == stdpad:
-                    ind = get_index(window)[1]
-                    stdpad.chgat(stdpad.getyx()[0], 0,
-                                 len("(%s)" % str(ind+1)),
-                                 curses.color_pair(5))
-                    stdpad.refresh(ytop, 0, 0, 0,
-                                   y_stdscr-2, x_stdscr)
-
-    def key_get_most_recent(window):
-        """get the most recent version to download directory"""
-
-        (i, ind) = get_index(window)
-        data = arxiv.data[ind]
-        last_version = version_list(data)[-1]
-        pdf_url = "http://arxiv.org/pdf/%s%s.pdf" % (data['arxiv_nr'],
-                                                     last_version)
-        print_status("getting %s" % pdf_url)
-        sock = urllib.urlopen(pdf_url)
-        pdfSource = sock.read()
-        sock.close()
-        if os.path.isdir(os.path.expandvars("${HOME}/downloads")):
-            download_dir = os.path.expandvars("${HOME}/downloads")
-        elif os.path.isdir(os.path.expandvars("${HOME}/Downloads")):
-            download_dir = os.path.expandvars("${HOME}/Downloads")
+        inds = [ind for ind in selected_entries(window)
+                if arxiv.data[ind].arxiv_nr]
+        arxiv_nrs = [arxiv.data[ind].arxiv_nr for ind in inds]
+        model = relevance[0]
+        if model is not None:
+            # the model has the title and abstract which were saved
+            for start in range(0, len(arxiv_nrs), 500):
+                for paper in db.select(arxiv_nrs=arxiv_nrs[start:start+500]):
+                    model.remove(paper['arxiv_nr'], paper['title'],
+                                 paper['abstract'])
+        removed = db.delete(arxiv_nrs)
+        logger.debug("SQL: deleted %d entries", len(removed))
+        saved.difference_update(removed)
+        if len(inds) == 1:
+            print_status("%s removed from db"
+                         % arxiv.data[inds[0]].arxiv_nr.encode("utf8"))
         else:
-            download_dir = "/tmp"
-        target = os.path.join(download_dir, "%s%s.pdf" % (data['arxiv_nr'],
-                                                          last_version))
-        # print_status("writting to %s" % target)
-        with open(target, "w") as sock:
-            sock.write(pdfSource)
-        print_status("written to %s" % target)
+            print_status("%d entries removed from db" % len(removed))
+        marked.clear()
+        print_titles(window)
 
-    def key_pdf_open(window):
-        """ download and open by the PDFVIEWER """
+    def download_most_recent(window, callback=None):
+        """
+        Start downloading the most recent version of the entry under the
+        cursor to DOWNLOADDIR (in the background).  If the file is already
+        there just call callback(target).
+        """
         (i, ind) = get_index(window)
-        data = arxiv.data[ind]
+        try:
+            data = arxiv.data[ind]
+        except IndexError:
+            return
         versions = version_list(data)
         if not versions:
             return
-        last_version = version_list(data)[-1]
-        target = os.path.join(os.path.expandvars(DOWNLOADDIR),
-                              "%s%s.pdf" % (data['arxiv_nr'], last_version))
-        if not os.path.exists(target):
-            key_get_most_recent(window)
+        last_version = versions[-1]
+        target = os.path.join(DOWNLOADDIR,
+                              "%s%s.pdf" % (data.arxiv_nr, last_version))
+        if os.path.exists(target):
+            print_status("%s exists" % target)
+            if callback:
+                callback(target)
+            return
+        pdf_url = "http://arxiv.org/pdf/%s%s.pdf" % (data.arxiv_nr,
+                                                     last_version)
+        if downloads.start(pdf_url, target, callback):
+            print_status("getting %s" % pdf_url)
+            # wake up to show the progress
+            titles_window.timeout(250)
+        else:
+            print_status("already getting %s" % pdf_url)
 
+    def key_get_most_recent(window):
+        """get the most recent version to download directory"""
+        download_most_recent(window)
+
+    def open_pdf(target):
         subprocess.Popen([PDFVIEWER, target],
                          stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE)
 
+    def key_pdf_open(window):
+        """ download and open by the PDFVIEWER """
+        download_most_recent(window, open_pdf)
+
+    def read_line(prompt):
+        """
+        Read a line of text on the status line.  Returns None if it was
+        cancelled with Escape.
+        """
+        (ymax, xmax) = stdscr.getmaxyx()
+        print_status(prompt)
+        edit_window = curses.newwin(1, xmax-len(prompt)-1,
+                                    ymax-1, len(prompt))
+        edit_window.keypad(1)
+        cancelled = []
+
+        def validate(ch):
+            if ch == 27:
+                cancelled.append(True)
+                return 7  # ^G: stop editing
+            elif ch == 127:
+                return 8  # ^H: backspace
+            return ch
+
+        curses.curs_set(1)
+        try:
+            text = curses.textpad.Textbox(edit_window).edit(validate)
+        finally:
+            curses.curs_set(0)
+        clear_status()
+        if cancelled:
+            return None
+        return text.strip().decode("utf8", "replace")
+
+    def show_search_results(query, results):
+        """
+        List the search results (rows of ArXivDB.search()) on the whole
+        screen: j, k move, a, Enter, Space toggle the abstract, u opens the
+        url, q closes the list.
+        """
+        (height, width) = (y_stdscr-1, x_stdscr)
+        results_window = curses.newwin(height, width, 0, 0)
+        results_window.keypad(1)
+        rows = max(1, (height-2)//2)
+            # number of results on the screen (two lines each)
+        current = 0
+        top = 0
+        show_abstract = False
+        while True:
+            if current < top:
+                top = current
+            elif current >= top+rows:
+                top = current-rows+1
+            results_window.erase()
+            results_window.addstr(0, 0,
+                                  ("%d results for: %s"
+                                   % (len(results), query))[:width-1]
+                                  .encode("utf8"),
+                                  curses.A_BOLD)
+            (arxiv_nr, title, authors, abstract, url, rank) = results[current]
+            if show_abstract:
+                lines = (textwrap.wrap(title or "", width-2) + [""]
+                         + textwrap.wrap("Authors: %s" % (authors or ""),
+                                         width-2) + [""]
+                         + textwrap.wrap(abstract or "", width-2))
+                for (ypos, line) in enumerate(lines[:height-2], 2):
+                    results_window.addstr(ypos, 1, line.encode("utf8"))
+            else:
+                for ind in range(top, min(top+rows, len(results))):
+                    ypos = 2+2*(ind-top)
+                    results_window.addstr(
+                        ypos, 0,
+                        ("(%d) %s" % (ind+1, results[ind][1] or ""))
+                        [:width-1].encode("utf8"),
+                        ind == current and curses.A_REVERSE or 0)
+                    results_window.addstr(
+                        ypos+1, 5,
+                        ("%s [%s]" % (results[ind][2] or "",
+                                      results[ind][0]))
+                        [:width-6].encode("utf8"),
+                        curses.color_pair(2))
+            results_window.touchwin()
+            results_window.refresh()
+            key = results_window.getch()
+            if key in (ord('q'), 27):
+                break
+            elif key in (ord('j'), curses.KEY_DOWN):
+                current = min(current+1, len(results)-1)
+            elif key in (ord('k'), curses.KEY_UP):
+                current = max(current-1, 0)
+            elif key in (ord('a'), ord(' '), 10, curses.KEY_ENTER):
+                show_abstract = not show_abstract
+            elif key == ord('u'):
+                key_open_url(results_window, url)
+
+    def key_search(window):
+        """
+        Full text search in the database, the results are ranked by bm25.
+        """
+        query = read_line("search: ")
+        if not query:
+            return
+        results = db.search(query)
+        if results is None:
+            print_status("No full text index (is there a database?).")
+            return
+        if not results:
+            print_status("Nothing found for: %s" % query.encode("utf8"))
+            return
+        show_search_results(query, results)
+        titles_window.touchwin()
+        titles_window.refresh()
+        clear_status()
+
     def key_help(window):
         # XXX: help should define its own window
         return
@@ -913,12 +3326,12 @@ if __name__ == "__main__":
             help = False
             (y, x) = window.getyx()
             window.erase()
-            print_titles(window, init=False)
+            view.invalidate()
+            print_titles(window)
             window.move(y, x)
             (i, ind) = get_index(window)
             window.chgat(y, 0, len("(%s)" % str(ind+1)), curses.color_pair(2))
-            window.refresh(ytop, 0, 0, 0,
-                           y_stdscr-2, x_stdscr)
+            window.refresh()
         else:
             help = True
             (y, x) = window.getyx()
@@ -935,15 +3348,108 @@ if __name__ == "__main__":
                           '-- open url using BROWSER=%s'
                           % os.getenv('BROWSER'))
             window.move(y, x)
-            window.refresh(ytop, 0, 0, 0,
-                           y_stdscr-2, x_stdscr)
+            window.refresh()
+
+    def apply_abstracts(window):
+        """
+        Store the abstracts fetched by the prefetcher in arxiv.data and
+        recolour their titles.
+        """
+        changed = False
+        while True:
+            try:
+                (ind, abstract) = prefetcher.done.get_nowait()
+            except Queue.Empty:
+                break
+            if not arxiv.data[ind].abstract:
+                arxiv.data[ind].abstract = abstract
+                changed = True
+        if changed:
+            print_titles(window)
+
+    def show_downloads():
+        """
+        Print the last message of the background downloads.
+        """
+        msg = None
+        while True:
+            try:
+                msg = downloads.messages.get_nowait()
+            except Queue.Empty:
+                break
+        if msg:
+            print_status(msg)
+
+    def background_busy():
+        return (prefetcher.busy() or not prefetcher.done.empty()
+                or downloads.busy() or not downloads.messages.empty())
+
+    def key_resize(window):
+        """
+        The terminal was resized (curses turns SIGWINCH into KEY_RESIZE):
+        resize the titles window in place and redraw it.  The titles are
+        rewrapped lazily (see TitleLayout) and the entry under the cursor
+        stays on the same row of the screen if it can.
+        """
+        global y_stdscr, x_stdscr
+        offset = title_layout(window).start(view.current)-view.top
+            # the row of the cursor on the screen, in the old layout
+        (y_stdscr, x_stdscr) = stdscr.getmaxyx()
+        if y_stdscr < 2:
+            return
+        window.resize(y_stdscr-1, x_stdscr)
+        stdscr.erase()
+        stdscr.refresh()
+        titles = title_layout(window)
+        view.top = max(0, titles.start(view.current)
+                       - max(0, min(offset, view.height()-1)))
+        view.follow()
+        view.invalidate()
+        print_titles(window)
+
+    def rank_entries():
+        """
+        Score the entries with the RelevanceModel of the saved papers: the
+        best tenth of them (with a positive score) are relevant, and with
+        ARXIV_RANK=sort the entries are sorted best first.  It is done once
+        all digests are parsed, before any key is handled.
+        """
+        if relevance[0] is None:
+            relevance[0] = RelevanceModel.load(ARXIV_MODEL)
+        model = relevance[0]
+        model.sync(db)
+        if not model.papers:
+            return
+        scores = model.scores(arxiv.data)
+        if not scores:
+            return
+        threshold = sorted(scores, reverse=True)[len(scores)//10]
+        relevant.update(data.arxiv_nr
+                        for (data, score) in zip(arxiv.data, scores)
+                        if score > 0 and score >= threshold)
+        if ARXIV_RANK == 'sort':
+            session.sort([-score for score in scores])
+            layout.forget(0)
+            (view.current, view.top) = (0, 0)
+        view.invalidate()
 
     def key_quit(window):
         """ Terminate """
+        apply_abstracts(window)
+        prefetcher.stop()
+        http_engine.close()
         curses.nocbreak()
         stdscr.keypad(0)
         curses.echo()
         curses.endwin()
+        db.close()
+        seen_papers.close()
+        cache_digest()
+        if relevance[0] is not None and relevance[0].changed:
+            try:
+                relevance[0].store(ARXIV_MODEL)
+            except (IOError, OSError) as e:
+                logger.warning("cannot store the relevance model: %s", e)
         sys.exit(os.EX_OK)
 
     """
@@ -953,7 +3459,24 @@ if __name__ == "__main__":
         """
         The main curses loop.
         """
-        print_titles(stdpad, init=True)
+        saved.update(db.saved([d.arxiv_nr for d in arxiv.data]))
+        if ARXIV_SEEN == 'dim':
+            seen.update(seen_papers.seen([d.arxiv_nr for d in arxiv.data]))
+        print_titles(titles_window)
+        parsed = len(arxiv.data)
+        with profile.timer("parse: the rest"):
+            for data in entries:
+                # parse the rest of the digest
+                pass
+        cache_digest()
+        saved.update(db.saved([d.arxiv_nr for d in arxiv.data[parsed:]]))
+        if ARXIV_SEEN == 'dim':
+            seen.update(seen_papers.seen([d.arxiv_nr
+                                          for d in arxiv.data[parsed:]]))
+        if ARXIV_RANK != 'off':
+            with profile.timer("rank"):
+                rank_entries()
+        print_titles(titles_window)
         keyboard_map = {curses.KEY_UP: key_up,
                         ord("k"): key_up,
                         curses.KEY_DOWN: key_down,
@@ -972,20 +3495,42 @@ if __name__ == "__main__":
                         25: key_move_up,
                         ord("s"): key_save_to_db,
                         ord("d"): key_delete_from_db,
+                        ord("m"): key_mark,
+                        ord("v"): key_mark_range,
+                        ord("M"): key_mark_highlighted,
+                        ord("c"): key_unmark,
+                        ord("/"): key_search,
                         ord("g"): key_get_most_recent,
-                        ord("O"): key_pdf_open
+                        ord("O"): key_pdf_open,
+                        curses.KEY_RESIZE: key_resize
                         }
         help = False
+        prefetcher.start((i, d) for (i, d) in enumerate(arxiv.data)
+                         if not d.abstract and d.url)
+        if prefetcher.busy():
+            # wake up to show the fetched abstracts
+            titles_window.timeout(250)
         try:
             while True:
-                key = stdpad.getch()
+                key = titles_window.getch()
+                apply_abstracts(titles_window)
+                show_downloads()
+                if key == -1:
+                    if not background_busy():
+                        titles_window.timeout(-1)
+                    continue
                 action = keyboard_map.get(key, None)
-                if action == key_open_url:
-                    (i, ind) = get_index(stdpad)
-                    url = arxiv.data[ind].get('url', '')
-                    action(stdpad, url)
-                elif action:
-                    action(stdpad)
+                if action is None:
+                    continue
+                with profile.timer(action.__name__):
+                    if action == key_open_url:
+                        (i, ind) = get_index(titles_window)
+                        url = arxiv.data[ind].url or ''
+                        action(titles_window, url)
+                    else:
+                        action(titles_window)
+                prefetcher.focus(
+                    title_layout(titles_window).entry_at(view.top))
         except KeyboardInterrupt:
             pass
 
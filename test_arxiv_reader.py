@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the network layer of arxiv_reader.py against a stand-in HTTP server
+on localhost:
+
+    python -m unittest test_arxiv_reader
+
+The server answers the paths listed in StandInHandler and records the
+headers of every request, so the tests can check what was sent (e.g.
+conditional and Range requests) as well as what was read.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+import arxiv_reader
+
+
+PAGE = "".join("line %d of the page\n" % i for i in range(20000))
+    # about 400 kB: more than a few chunks
+
+
+FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>ArXiv Query</title>
+  <entry>
+    <id>http://arxiv.org/abs/2410.12345v3</id>
+    <summary>  The first
+      abstract.  </summary>
+  </entry>
+  <entry>
+    <id>http://arxiv.org/abs/math/0601001v1</id>
+    <summary>The second abstract.</summary>
+  </entry>
+  <entry>
+    <id>http://arxiv.org/api/errors#incorrect_id_format</id>
+    <summary>not an entry</summary>
+  </entry>
+</feed>
+"""
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    /page: PAGE with an ETag, 304 if it is sent back in If-None-Match
+    /pdf: PAGE, honouring Range requests (/pdf-norange ignores them)
+    /slow: answers after 2 seconds
+    /close: PAGE, but the connection is closed after the response although
+        it is announced as kept alive
+    /api: FEED
+    """
+
+    protocol_version = "HTTP/1.1"
+    ETAG = '"v1"'
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        self.server.requests.append((self.path, dict(self.headers)))
+        if path == "/page":
+            if self.headers.get("If-None-Match") == self.ETAG:
+                self.send_response(304)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.reply(PAGE, ETag=self.ETAG)
+        elif path in ("/pdf", "/pdf-norange"):
+            byte_range = self.headers.get("Range")
+            if byte_range and path == "/pdf":
+                start = int(byte_range[len("bytes="):].rstrip("-"))
+                if start >= len(PAGE):
+                    self.reply("", status=416)
+                    return
+                self.reply(PAGE[start:], status=206,
+                           **{"Content-Range": "bytes %d-%d/%d"
+                              % (start, len(PAGE)-1, len(PAGE))})
+            else:
+                self.reply(PAGE)
+        elif path == "/slow":
+            time.sleep(2)
+            self.reply("late")
+        elif path == "/close":
+            self.reply(PAGE)
+            self.close_connection = 1
+        elif path == "/api":
+            self.reply(FEED, **{"Content-Type": "application/atom+xml"})
+        else:
+            self.reply("not found", status=404)
+
+    def reply(self, body, status=200, **headers):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except IOError:
+            # the client stopped reading (HTTPCache.get() with consume)
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           StandInHandler)
+        self.requests = []
+            # (path, headers) of every request
+
+    def handle_error(self, request, client_address):
+        # the client closed the connection (a page read only in part)
+        pass
+
+
+class NetworkTestCase(unittest.TestCase):
+    """
+    Starts the stand-in server and a fresh HTTPEngine (without proxies) for
+    every test.
+    """
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.engine = arxiv_reader.HTTPEngine(max_connections=2, timeout=0.5)
+        self.engine.proxies = {}
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.engine.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server.server_address[1], path)
+
+
+class HTTPEngineTest(NetworkTestCase):
+
+    def test_reuses_connection(self):
+        for _ in range(2):
+            with self.engine.open(self.url("/page")) as response:
+                self.assertEqual(response.status, 200)
+                self.assertEqual(response.read(), PAGE)
+        self.assertEqual(sum(len(conns) for conns
+                             in self.engine.idle.values()), 1)
+
+    def test_connection_closed_by_server(self):
+        with self.engine.open(self.url("/close")) as response:
+            response.read()
+        time.sleep(0.1)
+        with self.engine.open(self.url("/page")) as response:
+            self.assertEqual(response.read(), PAGE)
+
+    def test_timeout(self):
+        with self.engine.open(self.url("/page")) as response:
+            response.read()
+        # the request on the kept-alive connection is not sent again
+        start = time.time()
+        self.assertRaises(arxiv_reader.FetchError,
+                          self.engine.open, self.url("/slow"))
+        self.assertLess(time.time()-start, 1.0)
+
+
+class HTTPCacheTest(NetworkTestCase):
+
+    def setUp(self):
+        NetworkTestCase.setUp(self)
+        self.cache = arxiv_reader.HTTPCache(self.directory, ttl=0,
+                                            engine=self.engine)
+
+    def test_revalidation(self):
+        self.assertEqual(self.cache.get(self.url("/page")), PAGE)
+        self.assertEqual(self.cache.get(self.url("/page")), PAGE)
+        (first, second) = [headers for (path, headers)
+                           in self.server.requests]
+        self.assertNotIn("if-none-match", first)
+        self.assertEqual(second.get("if-none-match"), StandInHandler.ETAG)
+
+    def test_fresh_page(self):
+        self.cache.ttl = 60
+        self.cache.get(self.url("/page"))
+        self.assertEqual(self.cache.get(self.url("/page")), PAGE)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_consume_stops_early(self):
+        chunks = []
+
+        def consume(chunk):
+            chunks.append(chunk)
+            return True
+
+        page = self.cache.get(self.url("/page"), consume, chunk_size=1024)
+        self.assertEqual(chunks, [page])
+        self.assertTrue(PAGE.startswith(page))
+        self.assertLess(len(page), len(PAGE))
+
+    def test_partial_page_read_again(self):
+        self.cache.get(self.url("/page"), lambda chunk: True, chunk_size=1024)
+        # without a consumer the whole page is needed: it is not revalidated
+        self.assertEqual(self.cache.get(self.url("/page")), PAGE)
+        (path, headers) = self.server.requests[-1]
+        self.assertNotIn("if-none-match", headers)
+        self.assertEqual(self.cache.get(self.url("/page")), PAGE)
+
+    def test_partial_page_continued(self):
+        self.cache.ttl = 60
+        self.cache.get(self.url("/page"), lambda chunk: True, chunk_size=1024)
+        chunks = []
+        self.cache.get(self.url("/page"), chunks.append, chunk_size=1000)
+        # the consumer needs more than the cached part: it gets the rest
+        self.assertEqual("".join(chunks), PAGE)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_partial_page_enough(self):
+        self.cache.ttl = 60
+        page = self.cache.get(self.url("/page"), lambda chunk: True,
+                              chunk_size=1024)
+        chunks = []
+
+        def consume(chunk):
+            chunks.append(chunk)
+            return True
+
+        self.assertEqual(self.cache.get(self.url("/page"), consume), page)
+        self.assertEqual(chunks, [page])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_error(self):
+        self.assertRaises(IOError, self.cache.get, self.url("/missing"))
+
+
+class DownloadPDFTest(NetworkTestCase):
+
+    def setUp(self):
+        NetworkTestCase.setUp(self)
+        self.http_engine = arxiv_reader.http_engine
+        arxiv_reader.http_engine = self.engine
+        self.target = os.path.join(self.directory, "paper.pdf")
+
+    def tearDown(self):
+        arxiv_reader.http_engine = self.http_engine
+        NetworkTestCase.tearDown(self)
+
+    def interrupted(self, size):
+        with open(self.target+".part", "wb") as part:
+            part.write(PAGE[:size])
+
+    def content(self):
+        with open(self.target, "rb") as pdf:
+            return pdf.read()
+
+    def test_download(self):
+        progress = []
+        arxiv_reader.download_pdf(self.url("/pdf"), self.target,
+                                  lambda done, total: progress.append(done))
+        self.assertEqual(self.content(), PAGE)
+        self.assertEqual(progress[-1], len(PAGE))
+        self.assertFalse(os.path.exists(self.target+".part"))
+
+    def test_resume(self):
+        self.interrupted(1000)
+        arxiv_reader.download_pdf(self.url("/pdf"), self.target)
+        self.assertEqual(self.content(), PAGE)
+        (path, headers) = self.server.requests[-1]
+        self.assertEqual(headers.get("range"), "bytes=1000-")
+
+    def test_range_not_satisfiable(self):
+        # a .part longer than the file: it is downloaded again
+        self.interrupted(len(PAGE))
+        with open(self.target+".part", "ab") as part:
+            part.write("garbage")
+        arxiv_reader.download_pdf(self.url("/pdf"), self.target)
+        self.assertEqual(self.content(), PAGE)
+
+    def test_range_ignored(self):
+        self.interrupted(1000)
+        arxiv_reader.download_pdf(self.url("/pdf-norange"), self.target)
+        self.assertEqual(self.content(), PAGE)
+
+
+class ArXivAPITest(NetworkTestCase):
+
+    def test_lookup(self):
+        api = arxiv_reader.ArXivAPI(url=self.url("/api"), batch=1,
+                                    engine=self.engine)
+        records = api.lookup(["2410.12345", "math/0601001"])
+        # the stand-in answers every batch with the whole feed
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIn("id_list=2410.12345", self.server.requests[0][0])
+        records = dict((record.arxiv_nr, record) for record in records)
+        self.assertEqual(sorted(records), ["2410.12345", "math/0601001"])
+        self.assertEqual(records["2410.12345"].versions, ["v1", "v2", "v3"])
+        self.assertEqual(records["2410.12345"].abstract, "The first abstract.")
+        self.assertEqual(records["math/0601001"].versions, ["v1"])
+
+    def test_error(self):
+        api = arxiv_reader.ArXivAPI(url=self.url("/missing"),
+                                    engine=self.engine)
+        self.assertRaises(IOError, api.lookup, ["2410.12345"])
+
+    def test_metadata_store(self):
+        api = arxiv_reader.ArXivAPI(url=self.url("/api"), engine=self.engine)
+        store = arxiv_reader.MetadataStore(
+            arxiv_reader.HTTPCache(self.directory, engine=self.engine), api)
+        records = store.get_many(["2410.12345", "2410.99999"])
+        # the ids of the feed are those of the digest entries
+        self.assertEqual(sorted(records), ["2410.12345"])
+        self.assertEqual(records["2410.12345"].abstract,
+                         "The first abstract.")
+        store.get_many(["2410.12345"])
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class AbsPageExtractorTest(unittest.TestCase):
+    """
+    The extractor fed with an abs page in chunks of many sizes, so that the
+    tags it looks for are split between chunks.
+    """
+
+    PAGE = """<!DOCTYPE html>
+<html lang="en"><head><title>[2410.12345] A title</title></head>
+<body>
+<div id="abs">
+  <h1 class="title mathjax"><span class="descriptor">Title:</span>A title</h1>
+  <blockquote class="abstract mathjax">
+    <span class="descriptor">Abstract:</span>We study <em>things</em>.
+    H<sub>2</sub>O &amp; D<sub>2</sub>O are compared.<br>A second
+    paragraph.
+  </blockquote>
+</div>
+<div class="submission-history">
+  <h2>Submission history</h2>
+  From: An Author [<a href="/show-email/abc/2410.12345">view email</a>]
+  <br/><strong><a href="/abs/2410.12345v1" rel="nofollow">[v1]</a></strong>
+  Mon, 14 Oct 2024 12:00:00 UTC (100 KB)<br/>
+  <strong>[v2]</strong> Tue, 15 Oct 2024 12:00:00 UTC (110 KB)<br/>
+</div>
+""" + "<p>the rest of the page</p>\n" * 1000 + "</body></html>\n"
+
+    ABSTRACT = (u"We study things. H2O & D2O are compared. "
+                u"A second paragraph.")
+
+    def test_chunks(self):
+        history_end = self.PAGE.index("</div>",
+                                      self.PAGE.index("Submission history"))
+        for size in (1, 7, 64, 100, 333, 4096, len(self.PAGE)):
+            extractor = arxiv_reader.AbsPageExtractor()
+            read = 0
+            while read < len(self.PAGE):
+                chunk = self.PAGE[read:read+size]
+                read += len(chunk)
+                if extractor.feed(chunk):
+                    break
+            self.assertEqual(extractor.abstract, self.ABSTRACT, size)
+            self.assertEqual(extractor.version_list, ["v1", "v2"], size)
+            # the rest of the page is not read
+            self.assertLess(read, history_end+len("</div>")+size, size)
+
+    def test_truncated(self):
+        extractor = arxiv_reader.AbsPageExtractor()
+        page = self.PAGE[:self.PAGE.index("</blockquote>")]
+        self.assertFalse(extractor.feed(page))
+        extractor.close()
+        self.assertEqual(extractor.abstract, self.ABSTRACT)
+        self.assertEqual(extractor.version_list, [])
+
+
+if __name__ == "__main__":
+    unittest.main()